@@ -0,0 +1,364 @@
+# Offline load simulation for the ticket lifecycle.
+#
+# Drives AmountModal.on_submit → claim → complete → ConfirmCompleteTicket.yes against a fake
+# guild whose REST layer simulates Discord latency and per-route rate-limit buckets, then reports
+# handler latency percentiles, DB throughput, rate-limit stalls and whether the final ticket,
+# ledger and category state is consistent. The fake guild enforces the 50-channel category cap,
+# staff add channels by hand mid-run (forcing spill-over), and the Total Converted VC is live.
+#
+# --time-scale compresses the clock: latency, rate-limit windows and the bot's own VC rename /
+# category grace windows are all multiplied by it, so limits stay as tight relative to request
+# cost as they are on Discord.
+#
+#   python bench.py --tickets 2000 --concurrency 200
+#   python bench.py --tickets 500 --latency 120 --time-scale 0.2 > bench_output.txt
+import os, sys, time, random, shutil, asyncio, argparse, itertools, tempfile
+from types import SimpleNamespace
+from collections import defaultdict
+
+# bot.py reads its config at import time; point it at a scratch DB before importing
+_tmp = tempfile.mkdtemp(prefix="exchange-bench-")
+os.environ.setdefault("DISCORD_TOKEN", "bench")
+os.environ.update(GUILD_ID="1", HISTORY_CHANNEL="2", LOG_CHANNEL="3", EXCHANGE_CHANNEL="4",
+                  DB_PATH=os.path.join(_tmp, "bench.sqlite"))
+
+import discord
+import bot as app
+
+# ───────────── SIMULATED DISCORD REST ─────────────
+# route → (requests, window secs, bucket scope); windows are multiplied by --time-scale
+ROUTE_LIMITS = {
+    "category_create": (5,  10, "guild"),
+    "channel_create":  (50, 10, "guild"),
+    "channel_delete":  (5,  5,  "channel"),
+    "channel_perms":   (10, 10, "channel"),
+    "channel_rename":  (2, 600, "channel"),
+    "message_send":    (5,  5,  "channel"),
+    "message_edit":    (5,  5,  "channel"),
+    "interaction":     (None, 0, None),   # interaction callbacks aren't bucketed
+}
+GLOBAL_LIMIT = (50, 1)
+
+class FakeREST:
+    def __init__(self, latency_ms: float, time_scale: float):
+        self.latency, self.scale = latency_ms/1000*time_scale, time_scale
+        self.buckets: dict[tuple, list[float]] = defaultdict(list)   # key → request timestamps in window
+        self.calls = defaultdict(int)
+        self.stalls = defaultdict(int)
+        self.stall_secs = defaultdict(float)
+
+    async def _take(self, key, limit, window):
+        window *= self.scale; stalled = False
+        while True:
+            now = time.monotonic(); hits = self.buckets[key]
+            while hits and hits[0] <= now-window: hits.pop(0)
+            if len(hits) < limit:
+                hits.append(now); return 0.0
+            wait = hits[0]+window-now
+            if not stalled: self.stalls[key[0]] += 1; stalled = True   # requests stalled, not wake-ups
+            self.stall_secs[key[0]] += wait
+            await asyncio.sleep(wait)
+
+    async def call(self, route: str, scope_id: int = 0):
+        self.calls[route] += 1
+        await self._take(("global",), *GLOBAL_LIMIT)
+        limit, window, _scope = ROUTE_LIMITS[route]
+        if limit: await self._take((route, scope_id), limit, window)
+        # lognormal-ish jitter around the configured latency
+        await asyncio.sleep(self.latency*random.lognormvariate(0, 0.35))
+
+CATEGORY_CAP = 50
+rest: FakeREST = None   # set in main()
+ids = itertools.count(10_000)
+
+def gateway_dispatch(event: str, *args):
+    # what the gateway would deliver next; the bot never logs in, so call its handlers directly
+    handlers = [getattr(app.bot, f"on_{event}", None), *app.bot.extra_events.get(f"on_{event}", [])]
+    for h in handlers:
+        if h: asyncio.create_task(h(*args))
+
+# ───────────── FAKE GUILD ─────────────
+class FakeRole:
+    def __init__(self, name):
+        self.id, self.name = next(ids), name
+        self.mention = f"<@&{self.id}>"
+
+class FakeMember:
+    def __init__(self, guild, roles=()):
+        self.id, self.guild, self.roles = next(ids), guild, list(roles)
+        self.mention = f"<@{self.id}>"
+        self.display_avatar = SimpleNamespace(url=f"https://cdn.example/{self.id}.png")
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embeds=()):
+        self.id, self.channel, self.content, self.embeds = next(ids), channel, content, list(embeds)
+        self.author = app.bot.user
+
+class FakePartialMessage:
+    def __init__(self, channel, message_id): self.channel, self.id = channel, message_id
+    async def edit(self, **kw): await rest.call("message_edit", self.channel.id)
+
+class FakeTextChannel:
+    def __init__(self, guild, name, category):
+        self.id, self.guild, self.name, self.category = next(ids), guild, name, category
+        self.category_id = category.id if category else None
+        self.mention = f"<#{self.id}>"
+
+    async def send(self, content=None, *, embed=None, embeds=(), **kw):
+        await rest.call("message_send", self.id)
+        return FakeMessage(self, content, [embed] if embed else embeds)
+
+    def get_partial_message(self, message_id): return FakePartialMessage(self, message_id)
+
+    async def set_permissions(self, target, **kw): await rest.call("channel_perms", self.id)
+
+    async def delete(self):
+        await rest.call("channel_delete", self.id)
+        if self.category: self.category.channels.remove(self)
+        self.guild.channels.pop(self.id, None)
+        gateway_dispatch("guild_channel_delete", self)
+
+class FakeVoiceChannel(discord.VoiceChannel):
+    # a real VoiceChannel subclass so the bot's isinstance check passes
+    def __init__(self, guild, channel_id):
+        self.id, self.guild, self.name = channel_id, guild, "Total Converted"
+        self.renames = 0
+
+    async def edit(self, *, name):
+        await rest.call("channel_rename", self.id); self.name = name; self.renames += 1
+
+class FakeCategory:
+    def __init__(self, guild, name):
+        self.id, self.guild, self.name, self.channels = next(ids), guild, name, []
+        self.category_id = None
+
+    async def delete(self):
+        await rest.call("channel_delete", self.id)
+        self.guild.categories.remove(self); self.guild.channels.pop(self.id, None)
+
+class FakeGuild:
+    def __init__(self):
+        self.id = app.GUILD_ID
+        self.roles = [FakeRole("@everyone"), FakeRole("Exchanger")]+[FakeRole(n) for n in app.LIMITS]
+        self.default_role = self.roles[0]
+        self.categories: list[FakeCategory] = []
+        self.channels: dict[int, object] = {}
+        self.members: dict[int, FakeMember] = {}
+        self.me = self.member()
+        self.opened: dict[int, FakeTextChannel] = {}   # opener id → their latest ticket channel
+        for cid in (app.HISTORY_CHANNEL, app.LOG_CHANNEL):
+            ch = FakeTextChannel(self, f"ch-{cid}", None); ch.id = cid; self.channels[cid] = ch
+        self.vc = self.channels[app.VC_TOTAL_ID] = FakeVoiceChannel(self, app.VC_TOTAL_ID)
+        self.cap_hits = 0
+
+    def member(self, *role_names):
+        m = FakeMember(self, [r for r in self.roles if r.name in role_names]); self.members[m.id] = m
+        return m
+
+    def get_role(self, rid): return next((r for r in self.roles if r.id==rid), None)
+    def get_channel(self, cid): return self.channels.get(cid)
+    def get_member(self, mid): return self.members.get(mid)
+
+    async def create_category(self, name):
+        await rest.call("category_create", self.id)
+        cat = FakeCategory(self, name); self.categories.append(cat); self.channels[cat.id] = cat
+        return cat
+
+    async def create_text_channel(self, name, *, category=None, overwrites=None):
+        await rest.call("channel_create", self.id)
+        if category and len(category.channels) >= CATEGORY_CAP:
+            # what discord returns for a full category
+            self.cap_hits += 1
+            raise discord.HTTPException(SimpleNamespace(status=400, reason="Bad Request"), {
+                "code": 50035, "message": "Invalid Form Body",
+                "errors": {"parent_id": {"_errors": [{"code": "CHANNEL_PARENT_MAX_CHANNELS",
+                           "message": "Maximum number of channels in category reached (50)"}]}}})
+        ch = FakeTextChannel(self, name, category); self.channels[ch.id] = ch
+        if category: category.channels.append(ch)
+        for target in overwrites or {}:
+            if isinstance(target, FakeMember) and target is not self.me: self.opened[target.id] = ch
+        return ch
+
+# ───────────── FAKE INTERACTIONS ─────────────
+class FakeResponse:
+    def __init__(self, inter): self.inter, self.done, self.view = inter, False, None
+    async def _ack(self):
+        await rest.call("interaction")
+        if not self.done: self.done = True; self.inter.acked = time.perf_counter()
+    async def defer(self, **kw): await self._ack()
+    async def send_message(self, *a, view=None, **kw): self.view = view; await self._ack()
+    async def edit_message(self, **kw): await self._ack()
+    async def send_modal(self, modal): await self._ack()
+
+class FakeFollowup:
+    async def send(self, *a, **kw): await rest.call("interaction")
+
+class FakeInteraction:
+    def __init__(self, guild, user, channel=None, custom_id=None):
+        self.guild, self.user, self.channel = guild, user, channel
+        self.channel_id = channel.id if channel else None
+        self.type = discord.InteractionType.component if custom_id else discord.InteractionType.modal_submit
+        self.data = {"custom_id": custom_id} if custom_id else {}
+        self.response, self.followup, self.acked = FakeResponse(self), FakeFollowup(), None
+
+# ───────────── LIFECYCLE ─────────────
+class Results:
+    def __init__(self):
+        self.ack = defaultdict(list)     # handler → secs until the interaction was acknowledged
+        self.total = defaultdict(list)   # handler → secs until the handler returned
+        self.errors = defaultdict(int)
+        self.completed, self.expected_cents = 0, 0   # lifecycles that reached complete_confirm
+
+    async def run(self, name, inter, coro):
+        t0 = time.perf_counter()
+        try: await coro
+        except Exception as err:
+            self.errors[f"{name}: {type(err).__name__}: {err}"] += 1; return False
+        done = time.perf_counter()
+        self.ack[name].append((inter.acked or done)-t0); self.total[name].append(done-t0)
+        return True
+
+async def lifecycle(guild, exchangers, res: Results):
+    methods = [m[0] for m in app.PAYMENT_METHODS]
+    frm, to = random.sample(methods, 2)
+    customer = guild.member()
+    modal = app.AmountModal(SimpleNamespace(from_method=frm, to_method=to))
+    modal.amount._value = f"{random.uniform(20, 900):.2f}"
+    inter = FakeInteraction(guild, customer)
+    if not await res.run("modal_submit", inter, modal.on_submit(inter)): return
+    chan = guild.opened[customer.id]
+    # the claim button lives on the intro message; nobody can click it before it's posted
+    if not await wait_for_intro(chan.id):
+        res.errors["intro never posted"] += 1; return
+
+    exchanger = random.choice(exchangers)
+    inter = FakeInteraction(guild, exchanger, chan, f"ticket:claim:{chan.id}")
+    if not await res.run("claim", inter, app.ticket_router.dispatch(inter)): return
+
+    inter = FakeInteraction(guild, exchanger, chan, f"ticket:complete:{chan.id}")
+    if not await res.run("complete", inter, app.ticket_router.dispatch(inter)): return
+    confirm = inter.response.view
+
+    t = app.tickets.get(chan.id)
+    inter = FakeInteraction(guild, exchanger, chan)
+    if await res.run("complete_confirm", inter, confirm.yes.callback(inter)):
+        res.completed += 1; res.expected_cents += t.amount
+
+async def wait_for_intro(channel_id, timeout=30.0):
+    deadline = time.monotonic()+timeout
+    while time.monotonic() < deadline:
+        t = app.tickets.get(channel_id)
+        if t is None: return False
+        if t.message_id: return True
+        await asyncio.sleep(0.01)
+    return False
+
+async def add_manual_channels(guild, n, every):
+    # staff create channels in ticket categories by hand; the allocator only finds out from a 400
+    for _ in range(n):
+        await asyncio.sleep(every)
+        cats = [c for c in guild.categories if c.channels]
+        if cats:
+            cat = random.choice(cats); ch = FakeTextChannel(guild, "staff-notes", cat)
+            guild.channels[ch.id] = ch; cat.channels.append(ch)
+
+async def check_state(res: Results, guild) -> list[str]:
+    # the run only counts if what's persisted matches what the handlers reported
+    problems = []
+    statuses = dict(await app.db.fetchall("SELECT status,COUNT(*) FROM tickets GROUP BY status;"))
+    if statuses.get("completed", 0) != res.completed or set(statuses) - {"completed"}:
+        problems.append(f"ticket statuses {statuses}, expected completed={res.completed}")
+    if app.tickets.open: problems.append(f"{len(app.tickets.open)} ticket(s) still open in memory")
+    committed = (await app.db.fetchone("SELECT COUNT(*) FROM exchanges;"))[0]
+    if committed != res.completed: problems.append(f"{committed} exchanges committed, expected {res.completed}")
+    total = (await app.db.fetchone("SELECT total FROM global_total WHERE id=1;"))[0]
+    ex, cu = await app.db.fetchone("SELECT SUM(as_exchanger),SUM(as_customer) FROM user_totals;")
+    if not total == (ex or 0) == (cu or 0) == res.expected_cents:
+        problems.append(f"totals global={total} exchangers={ex} customers={cu}, expected {res.expected_cents}")
+    full = [c.name for c in guild.categories if len(c.channels) > CATEGORY_CAP]
+    if full: problems.append(f"categories over the cap: {full}")
+    return problems
+
+def pct(values, p):
+    if not values: return float("nan")
+    s = sorted(values)
+    return s[min(len(s)-1, max(0, round(p/100*len(s))-1))]
+
+async def main(args):
+    global rest
+    rest = FakeREST(args.latency, args.time_scale)
+    random.seed(args.seed)
+    app.LEDGER_FLUSH_SECS = args.flush_secs
+    app.VC_RENAME_WINDOW *= args.time_scale; app.CATEGORY_GRACE *= args.time_scale
+    await app.db.start(); await app.init_db()
+    await app.leaderboards.load(); await app.messages.load(); await app.tickets.load()
+    await app.ledger.start(); app.jobs.start(); app.log_sink.start()
+
+    guild = FakeGuild()
+    # the bot never logs in: wire its channel lookup to the fake guild and mark it ready
+    app.bot.get_channel = guild.get_channel
+    await app.bot._async_setup_hook(); app.bot._ready.set()
+    app.total_updater.start()
+    exchangers = [guild.member("Exchanger", "CAN EXCHANGE ANY AMOUNT") for _ in range(args.exchangers)]
+    res, gate = Results(), asyncio.Semaphore(args.concurrency)
+    async def one():
+        async with gate: await lifecycle(guild, exchangers, res)
+
+    t0 = time.perf_counter()
+    manual = asyncio.create_task(add_manual_channels(guild, args.manual_channels, args.latency/1000*args.time_scale*20))
+    await asyncio.gather(*(one() for _ in range(args.tickets)))
+    handlers_done = time.perf_counter()-t0
+    manual.cancel()
+    await app.log_sink.stop(); await app.jobs.stop(timeout=args.drain_timeout)
+    drained = time.perf_counter()-t0
+    app.total_updater.stop()
+    t1 = time.perf_counter(); await app.ledger.stop(); final_flush = time.perf_counter()-t1
+    committed = (await app.db.fetchone("SELECT COUNT(*) FROM exchanges;"))[0]
+    for problem in await check_state(res, guild): res.errors[f"state: {problem}"] += 1
+    await app.db.close()
+
+    print(f"tickets={args.tickets} concurrency={args.concurrency} latency={args.latency}ms time_scale={args.time_scale}")
+    print(f"handlers finished in {handlers_done:.2f}s, side-effect jobs drained at {drained:.2f}s "
+          f"(queue depth left: {app.jobs.depth})")
+    print("\nhandler             n      ack p50   ack p99   total p50 total p99   (ms)")
+    for name in ("modal_submit", "claim", "complete", "complete_confirm"):
+        a, t = res.ack[name], res.total[name]
+        print(f"{name:<18}{len(t):>5}  {pct(a,50)*1e3:>9.1f} {pct(a,99)*1e3:>9.1f} {pct(t,50)*1e3:>9.1f} {pct(t,99)*1e3:>9.1f}")
+    late = sum(x > 3.0 for v in res.ack.values() for x in v)
+    print(f"acks over Discord's 3s deadline: {late}")
+
+    print(f"\nledger: {committed} exchanges committed ({committed/max(handlers_done,1e-9):.1f}/s while handlers ran), "
+          f"final flush {final_flush*1e3:.1f}ms")
+    print("db query            calls    avg ms    max ms")
+    for q,(calls,total,worst) in sorted(app.db.stats.items(), key=lambda kv: -kv[1][1]):
+        print(f"{q[:18]:<18}{calls:>7} {total/calls*1e3:>9.2f} {worst*1e3:>9.2f}")
+
+    print("\nREST route          calls   stalls   stalled s")
+    for route in sorted(rest.calls):
+        print(f"{route:<18}{rest.calls[route]:>7} {rest.stalls[route]:>8} {rest.stall_secs[route]:>11.2f}")
+    print(f"{'global':<18}{'':>7} {rest.stalls['global']:>8} {rest.stall_secs['global']:>11.2f}")
+    print(f"categories: {len(guild.categories)} live, {guild.cap_hits} create(s) bounced off the cap; "
+          f"VC renamed {guild.vc.renames}× to {guild.vc.name!r}")
+
+    if app.jobs.stats:
+        print("\njob                 done   dead    avg ms")
+        for name,(done,dead,total,_w) in sorted(app.jobs.stats.items()):
+            print(f"{name:<18}{done:>6} {dead:>6} {total/max(done+dead,1)*1e3:>9.1f}")
+    if res.errors:
+        print("\nerrors:")
+        for err,n in sorted(res.errors.items(), key=lambda kv: -kv[1]): print(f"  {n}× {err}")
+    return 1 if res.errors else 0
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Simulate concurrent ticket lifecycles against a fake Discord.")
+    p.add_argument("--tickets", type=int, default=1000)
+    p.add_argument("--concurrency", type=int, default=100)
+    p.add_argument("--exchangers", type=int, default=25)
+    p.add_argument("--latency", type=float, default=80, help="median REST latency in ms")
+    p.add_argument("--time-scale", type=float, default=0.1, help="clock multiplier for latency and rate-limit windows")
+    p.add_argument("--manual-channels", type=int, default=20, help="channels staff add to ticket categories by hand")
+    p.add_argument("--flush-secs", type=float, default=0.25, help="ledger flush window")
+    p.add_argument("--drain-timeout", type=float, default=120)
+    p.add_argument("--seed", type=int, default=1)
+    try: sys.exit(asyncio.run(main(p.parse_args())))
+    finally: shutil.rmtree(_tmp, ignore_errors=True)
@@ -1,7 +1,11 @@
-import os, re, discord, aiosqlite
+from __future__ import annotations
+import os, re, math, time, json, uuid, random, asyncio, logging, hashlib, functools, itertools, contextlib, discord, aiosqlite
 from discord.ext import commands, tasks
-from discord import ui
+from discord import ui, app_commands
 from datetime import datetime, timezone
+from collections import deque
+from decimal import Decimal, ROUND_HALF_UP
+from dataclasses import dataclass, astuple
 from dotenv import load_dotenv
 from aiohttp import web
 
@@ -13,108 +17,855 @@ HISTORY_CHANNEL   = int(os.getenv("HISTORY_CHANNEL"))
 LOG_CHANNEL       = int(os.getenv("LOG_CHANNEL", 1386775183762657280))
 EXCHANGE_CHANNEL  = int(os.getenv("EXCHANGE_CHANNEL"))
 EXCHANGE_CATEGORY = os.getenv("EXCHANGE_CATEGORY", "Needs Convert")
+CATEGORY_CAP      = 50   # discord's channels-per-category limit
+CATEGORY_TRIES    = 3    # categories tried before giving up on a ticket channel
+CATEGORY_GRACE    = int(os.getenv("CATEGORY_GRACE", 600))   # secs an empty overflow category is kept
 
 # new channels & roles
 VC_TOTAL_ID       = int(os.getenv("VC_TOTAL_ID", 1386770317497864425))
 LB_EXCH_ID        = int(os.getenv("LB_EXCH_ID", 1402479459843575860))
 LB_CUST_ID        = int(os.getenv("LB_CUST_ID", 1402479617641812058))
 
-# styling & fees
+# discord allows ~2 channel renames per 10 minutes
+VC_RENAMES_PER_WINDOW = 2
+VC_RENAME_WINDOW      = 600
+
+# background job pipeline
+JOB_WORKERS  = int(os.getenv("JOB_WORKERS", 4))
+JOB_ATTEMPTS = 5
+
+# audit log batching (discord allows 10 embeds per message)
+LOG_BATCH      = 10
+LOG_FLUSH_SECS = float(os.getenv("LOG_FLUSH_SECS", 5.0))
+
+# styling
 BRAND_BLUE = 0x1E90FF
-MIN_FEE    = 3.0
 
-# role → max limit (None = unlimited)
+# role → max limit in dollars (None = unlimited)
 LIMITS = {
     "CAN EXCHANGE ANY AMOUNT":        None,
-    "Dont Exchange 250+ (NEVER DM)":  250.0,
-    "Dont Exchange 100+ (NEVER DM)":  100.0,
+    "Dont Exchange 250+ (NEVER DM)":  "250",
+    "Dont Exchange 100+ (NEVER DM)":  "100",
 }
 
+# fee schedule; money is written as decimal strings and compiled to integer cents
+MIN_FEE      = "5.00"
+DEFAULT_RATE = "0.10"   # methods missing from the schedule
 PAYMENT_METHODS = [
-    ("PayPal",   "10 % Fee", "<:paypal:1386798710276755557>"),
-    ("Venmo",    "10 % Fee", "<:venmo:1386798812173172796>"),
-    ("ApplePay", "10 % Fee", "<:applepay:1386799029802893394>"),
-    ("Zelle",    "10 % Fee", "<:zelle:1386799028611842068>"),
-    ("Chime",    "10 % Fee", "<:chime:1386799209264578731>"),
-    ("Cashapp",  "10 % Fee", "<:cashapp:1386799345344708648>"),
-    ("Crypto",    "5 % Fee", "<:crypto:1386799490198933625>"),
+    # name,       emoji,                           rate (select labels are derived from it)
+    ("PayPal",   "<:paypal:1386798710276755557>",   DEFAULT_RATE),
+    ("Venmo",    "<:venmo:1386798812173172796>",    DEFAULT_RATE),
+    ("ApplePay", "<:applepay:1386799029802893394>", DEFAULT_RATE),
+    ("Zelle",    "<:zelle:1386799028611842068>",    DEFAULT_RATE),
+    ("Chime",    "<:chime:1386799209264578731>",    DEFAULT_RATE),
+    ("Cashapp",  "<:cashapp:1386799345344708648>",  DEFAULT_RATE),
+    ("Crypto",   "<:crypto:1386799490198933625>",   "0.05"),
+]
+# (from, to) → (rate, minimum) overriding the sending method's defaults
+PAIR_FEES: dict[tuple[str, str], tuple[str, str]] = {}
+# (start, end or None, minimum, label) windows that lower the minimum fee
+FEE_PROMOS = [
+    (datetime(2025, 6, 1, tzinfo=timezone.utc), None, "3.00", "Launch Flash Sale!"),
 ]
 
 # ─────────── DATABASE UTILITIES ───────────
-DB_PATH = "data.sqlite"
+DB_PATH    = os.getenv("DB_PATH", "data.sqlite")
+DB_READERS = int(os.getenv("DB_READERS", 3))
+
+class Database:
+    # long-lived connections: one writer + a small pool of readers, all in WAL mode
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path, self.n_readers = path, readers
+        self.writer: aiosqlite.Connection|None = None
+        self.readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self.write_lock = asyncio.Lock()
+        self.stats: dict[str, list] = {}   # query name → [calls, total secs, max secs]
+
+    async def _open(self) -> aiosqlite.Connection:
+        # sqlite3 keeps a per-connection prepared statement cache, so reuse pays off
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        await conn.execute("PRAGMA journal_mode=WAL;")
+        await conn.execute("PRAGMA synchronous=NORMAL;")
+        await conn.execute("PRAGMA busy_timeout=5000;")
+        return conn
+
+    async def start(self):
+        if self.writer: return
+        self.writer = await self._open()
+        for _ in range(self.n_readers): self.readers.put_nowait(await self._open())
+
+    async def close(self):
+        if self.writer: await self.writer.close(); self.writer = None
+        while not self.readers.empty(): await self.readers.get_nowait().close()
+
+    def _record(self, name: str, t0: float):
+        dt = time.perf_counter()-t0
+        s = self.stats.setdefault(name, [0, 0.0, 0.0])
+        s[0] += 1; s[1] += dt; s[2] = max(s[2], dt)
+
+    async def fetchall(self, sql: str, params=(), *, name: str|None = None):
+        conn = await self.readers.get(); t0 = time.perf_counter()
+        try:
+            cur = await conn.execute(sql, params)
+            return await cur.fetchall()
+        finally:
+            self.readers.put_nowait(conn); self._record(name or sql, t0)
+
+    async def fetchone(self, sql: str, params=(), *, name: str|None = None):
+        rows = await self.fetchall(sql, params, name=name)
+        return rows[0] if rows else None
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, name: str = "transaction", *, durable: bool = False):
+        # all writes go through the single writer connection, one transaction at a time;
+        # durable commits fsync the WAL (synchronous=FULL) so they survive power loss,
+        # everything else keeps NORMAL and stays cheap
+        async with self.write_lock:
+            t0 = time.perf_counter()
+            if durable: await self.writer.execute("PRAGMA synchronous=FULL;")
+            try:
+                yield self.writer
+                await self.writer.commit()
+            except BaseException:
+                await self.writer.rollback(); raise
+            finally:
+                if durable: await self.writer.execute("PRAGMA synchronous=NORMAL;")
+                self._record(name, t0)
+
+    async def execute(self, sql: str, params=(), *, name: str|None = None):
+        async with self.transaction(name or sql) as conn:
+            await conn.execute(sql, params)
+
+db = Database(DB_PATH)
+
+# table name → DDL; money columns are integer cents
+SCHEMA = {
+    "global_total": """
+        CREATE TABLE IF NOT EXISTS global_total (
+          id    INTEGER PRIMARY KEY CHECK(id=1),
+          total INTEGER NOT NULL
+        );""",
+    "user_totals": """
+        CREATE TABLE IF NOT EXISTS user_totals (
+          user_id      INTEGER PRIMARY KEY,
+          as_exchanger INTEGER NOT NULL DEFAULT 0,
+          as_customer  INTEGER NOT NULL DEFAULT 0
+        );""",
+    # append-only ledger; user_totals/global_total are derived from it
+    "exchanges": """
+        CREATE TABLE IF NOT EXISTS exchanges (
+          id           INTEGER PRIMARY KEY,
+          uid          TEXT    NOT NULL UNIQUE,
+          exchanger_id INTEGER NOT NULL,
+          customer_id  INTEGER NOT NULL,
+          amount       INTEGER NOT NULL,
+          fee          INTEGER NOT NULL DEFAULT 0,
+          method       TEXT    NOT NULL DEFAULT '',
+          ts           INTEGER NOT NULL
+        );""",
+    # messages the bot owns (panel, leaderboards), keyed by purpose
+    "bot_messages": """
+        CREATE TABLE IF NOT EXISTS bot_messages (
+          purpose      TEXT    PRIMARY KEY,
+          channel_id   INTEGER NOT NULL,
+          message_id   INTEGER NOT NULL,
+          content_hash TEXT    NOT NULL DEFAULT ''
+        );""",
+    # side-effect jobs that ran out of retries
+    "dead_jobs": """
+        CREATE TABLE IF NOT EXISTS dead_jobs (
+          id        INTEGER PRIMARY KEY,
+          name      TEXT    NOT NULL,
+          context   TEXT    NOT NULL DEFAULT '',
+          error     TEXT    NOT NULL,
+          attempts  INTEGER NOT NULL,
+          failed_at INTEGER NOT NULL
+        );""",
+    # local mirror of every log_event, so audits don't need the discord API
+    "audit_log": """
+        CREATE TABLE IF NOT EXISTS audit_log (
+          id          INTEGER PRIMARY KEY,
+          ts          INTEGER NOT NULL,
+          title       TEXT    NOT NULL,
+          description TEXT    NOT NULL,
+          colour      INTEGER NOT NULL,
+          user_id     INTEGER,
+          channel_id  INTEGER
+        );""",
+    # source of truth for tickets, keyed by their channel
+    "tickets": """
+        CREATE TABLE IF NOT EXISTS tickets (
+          channel_id  INTEGER PRIMARY KEY,
+          opener_id   INTEGER NOT NULL,
+          from_method TEXT    NOT NULL,
+          to_method   TEXT    NOT NULL,
+          amount      INTEGER NOT NULL,
+          fee         INTEGER NOT NULL,
+          net         INTEGER NOT NULL,
+          status      TEXT    NOT NULL DEFAULT 'open',
+          claimed_by  INTEGER,
+          message_id  INTEGER,
+          created_at  INTEGER NOT NULL,
+          closed_at   INTEGER
+        );""",
+    # small key/value store for startup state (command tree hash, …)
+    "bot_meta": """
+        CREATE TABLE IF NOT EXISTS bot_meta (
+          key   TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        );""",
+    # daily rollups maintained by the ledger, so windowed stats only touch buckets in range
+    "user_daily": """
+        CREATE TABLE IF NOT EXISTS user_daily (
+          day          INTEGER NOT NULL,   -- days since epoch (UTC)
+          user_id      INTEGER NOT NULL,
+          as_exchanger INTEGER NOT NULL DEFAULT 0,
+          as_customer  INTEGER NOT NULL DEFAULT 0,
+          PRIMARY KEY(day, user_id)
+        ) WITHOUT ROWID;""",
+    "method_daily": """
+        CREATE TABLE IF NOT EXISTS method_daily (
+          day       INTEGER NOT NULL,
+          method    TEXT    NOT NULL,
+          volume    INTEGER NOT NULL DEFAULT 0,
+          fees      INTEGER NOT NULL DEFAULT 0,
+          exchanges INTEGER NOT NULL DEFAULT 0,
+          PRIMARY KEY(day, method)
+        ) WITHOUT ROWID;""",
+}
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_audit_log_ts ON audit_log(ts);",
+    "CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status);",
+    # covering indexes for the SQL leaderboard fallback
+    "CREATE INDEX IF NOT EXISTS idx_user_totals_exchanger ON user_totals(as_exchanger DESC, user_id);",
+    "CREATE INDEX IF NOT EXISTS idx_user_totals_customer ON user_totals(as_customer DESC, user_id);",
+]
+# columns that held float dollars before schema version 2
+MONEY_COLUMNS = {
+    "global_total": ("total",),
+    "user_totals":  ("as_exchanger", "as_customer"),
+    "exchanges":    ("amount", "fee"),
+    "tickets":      ("amount", "fee", "net"),
+    "user_daily":   ("as_exchanger", "as_customer"),
+    "method_daily": ("volume", "fees"),
+}
+SCHEMA_VERSION = 2
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS global_total (
-              id    INTEGER PRIMARY KEY CHECK(id=1),
-              total REAL NOT NULL
-            );
-        """)
-        await db.execute("INSERT OR IGNORE INTO global_total(id,total) VALUES(1,0);")
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_totals (
-              user_id      INTEGER PRIMARY KEY,
-              as_exchanger REAL NOT NULL DEFAULT 0,
-              as_customer  REAL NOT NULL DEFAULT 0
-            );
-        """)
-        await db.commit()
-
-async def add_exchange(exchanger_id: int, customer_id: int, amount: float):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # update global total
-        await db.execute("UPDATE global_total SET total = total + ? WHERE id = 1;", (amount,))
-        # update per-user fields
+    async with db.transaction("init_db") as conn:
+        await conn.execute("BEGIN IMMEDIATE;")   # DDL included, so a failed migration rolls back whole
+        fresh = not await (await conn.execute("SELECT 1 FROM sqlite_master WHERE name='global_total';")).fetchone()
+        for ddl in SCHEMA.values(): await conn.execute(ddl)
+        await conn.execute("INSERT OR IGNORE INTO global_total(id,total) VALUES(1,0);")
+        # one-shot migrations, tracked in PRAGMA user_version
+        version = SCHEMA_VERSION if fresh else (await (await conn.execute("PRAGMA user_version;")).fetchone())[0]
+        if version < 1:
+            # backfill the daily rollups from the ledger
+            await conn.execute(
+                "INSERT INTO user_daily(day,user_id,as_exchanger,as_customer) "
+                "SELECT ts/86400, exchanger_id, SUM(amount), 0 FROM exchanges WHERE true GROUP BY 1,2 "
+                "ON CONFLICT(day,user_id) DO UPDATE SET as_exchanger = as_exchanger + excluded.as_exchanger;")
+            await conn.execute(
+                "INSERT INTO user_daily(day,user_id,as_exchanger,as_customer) "
+                "SELECT ts/86400, customer_id, 0, SUM(amount) FROM exchanges WHERE true GROUP BY 1,2 "
+                "ON CONFLICT(day,user_id) DO UPDATE SET as_customer = as_customer + excluded.as_customer;")
+            await conn.execute(
+                "INSERT OR REPLACE INTO method_daily(day,method,volume,fees,exchanges) "
+                "SELECT ts/86400, method, SUM(amount), SUM(fee), COUNT(*) FROM exchanges GROUP BY 1,2;")
+        if version < 2:
+            # REAL dollars → INTEGER cents; column affinity can't be altered, so rebuild each table
+            for table, money in MONEY_COLUMNS.items():
+                await conn.execute(f"ALTER TABLE {table} RENAME TO {table}_v1;")
+                await conn.execute(SCHEMA[table])
+                cols = [r[1] for r in await (await conn.execute(f"PRAGMA table_info({table}_v1);")).fetchall()]
+                exprs = [f"CAST(ROUND({c}*100) AS INTEGER)" if c in money else c for c in cols]
+                await conn.execute(f"INSERT INTO {table}({','.join(cols)}) SELECT {','.join(exprs)} FROM {table}_v1;")
+                await conn.execute(f"DROP TABLE {table}_v1;")
+        if version < SCHEMA_VERSION: await conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        for ddl in INDEXES: await conn.execute(ddl)
+
+LEDGER_JOURNAL    = os.getenv("LEDGER_JOURNAL", DB_PATH+".ledger")
+LEDGER_FLUSH_SECS = float(os.getenv("LEDGER_FLUSH_SECS", 1.0))
+LEDGER_BATCH      = 200
+
+UPSERT_EXCHANGER = ("INSERT INTO user_totals(user_id,as_exchanger,as_customer) VALUES(?,?,0) "
+                    "ON CONFLICT(user_id) DO UPDATE SET as_exchanger = as_exchanger + excluded.as_exchanger;")
+UPSERT_CUSTOMER  = ("INSERT INTO user_totals(user_id,as_exchanger,as_customer) VALUES(?,0,?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET as_customer = as_customer + excluded.as_customer;")
+UPSERT_USER_DAY  = ("INSERT INTO user_daily(day,user_id,as_exchanger,as_customer) VALUES(?,?,?,?) "
+                    "ON CONFLICT(day,user_id) DO UPDATE SET as_exchanger = as_exchanger + excluded.as_exchanger, "
+                    "as_customer = as_customer + excluded.as_customer;")
+UPSERT_METHOD_DAY = ("INSERT INTO method_daily(day,method,volume,fees,exchanges) VALUES(?,?,?,?,?) "
+                     "ON CONFLICT(day,method) DO UPDATE SET volume = volume + excluded.volume, "
+                     "fees = fees + excluded.fees, exchanges = exchanges + excluded.exchanges;")
+
+class ExchangeLedger:
+    # write-behind: completions are fsync'd to an append-only journal (group commit),
+    # then folded into the DB in one transaction per flush window
+    def __init__(self, path: str):
+        self.path = path
+        self.unsynced: list[tuple[dict, asyncio.Future]] = []   # waiting for the journal fsync
+        self.pending: list[dict] = []                           # journaled, not yet in the DB
+        self.pending_total = 0   # cents
+        self.db_total = 0        # committed global_total, updated in step with pending_total
+        self.io_lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+        self.task: asyncio.Task|None = None
+
+    def _append(self, data: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data); f.flush(); os.fsync(f.fileno())
+
+    def _read(self) -> list[dict]:
+        if not os.path.exists(self.path): return []
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try: e = json.loads(line)
+                except ValueError: continue   # torn tail from a crash mid-write
+                if isinstance(e["amount"], float):
+                    # journaled before the switch to cents
+                    e["amount"], e["fee"] = to_cents(e["amount"]), to_cents(e["fee"])
+                entries.append(e)
+        return entries
+
+    def _rewrite(self, entries: list[dict]):
+        # compact the journal to the entries still owed to the DB; atomic via rename
+        tmp = self.path+".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e)+"\n" for e in entries)); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try: os.fsync(fd)
+        finally: os.close(fd)
+
+    async def _sync(self):
+        # whoever holds the lock writes every queued entry with a single fsync
+        async with self.io_lock:
+            batch, self.unsynced = self.unsynced, []
+            if not batch: return
+            try:
+                await asyncio.to_thread(self._append, "".join(json.dumps(e)+"\n" for e,_ in batch))
+            except Exception as err:
+                for _,fut in batch: fut.set_exception(err)
+                return
+        for e,fut in batch:
+            self.pending.append(e); self.pending_total += e["amount"]; fut.set_result(None)
+        if len(self.pending) >= LEDGER_BATCH: self.wake.set()
+
+    async def record(self, exchanger_id: int, customer_id: int, amount: int, fee: int = 0, method: str = ""):
+        e = {"uid": uuid.uuid4().hex, "exchanger_id": exchanger_id, "customer_id": customer_id,
+             "amount": amount, "fee": fee, "method": method, "ts": int(time.time())}
+        fut = asyncio.get_running_loop().create_future()
+        self.unsynced.append((e, fut))
+        await self._sync()
+        await fut
+
+    async def _apply(self, batch: list[dict]):
+        ex, cu, total = {}, {}, 0
+        user_days: dict[tuple, list] = {}     # (day, user) → [as_exchanger, as_customer]
+        method_days: dict[tuple, list] = {}   # (day, method) → [volume, fees, exchanges]
+        # durable: the journal drops these entries as soon as this commits
+        async with db.transaction("ledger_flush", durable=True) as conn:
+            for e in batch:
+                cur = await conn.execute(
+                    "INSERT OR IGNORE INTO exchanges(uid,exchanger_id,customer_id,amount,fee,method,ts) "
+                    "VALUES(:uid,:exchanger_id,:customer_id,:amount,:fee,:method,:ts);", e)
+                if cur.rowcount != 1: continue   # already applied before a crash; journal replay is idempotent
+                ex[e["exchanger_id"]] = ex.get(e["exchanger_id"], 0)+e["amount"]
+                cu[e["customer_id"]]  = cu.get(e["customer_id"], 0)+e["amount"]
+                total += e["amount"]
+                day = e["ts"]//86400
+                user_days.setdefault((day, e["exchanger_id"]), [0, 0])[0] += e["amount"]
+                user_days.setdefault((day, e["customer_id"]), [0, 0])[1] += e["amount"]
+                m = method_days.setdefault((day, e["method"]), [0, 0, 0])
+                m[0] += e["amount"]; m[1] += e["fee"]; m[2] += 1
+            if ex:
+                await conn.execute("UPDATE global_total SET total = total + ? WHERE id = 1;", (total,))
+                await conn.executemany(UPSERT_EXCHANGER, list(ex.items()))
+                await conn.executemany(UPSERT_CUSTOMER, list(cu.items()))
+                await conn.executemany(UPSERT_USER_DAY, [(*k, *v) for k,v in user_days.items()])
+                await conn.executemany(UPSERT_METHOD_DAY, [(*k, *v) for k,v in method_days.items()])
+            committed = (await (await conn.execute("SELECT total FROM global_total WHERE id = 1;")).fetchone())[0]
+        return ex, cu, committed
+
+    async def flush(self):
+        if not self.pending: return
+        batch = self.pending[:]
+        ex, cu, committed = await self._apply(batch)
+        # no await between these, so get_global_total never sees the batch in both totals
+        del self.pending[:len(batch)]
+        self.db_total = committed; self.pending_total -= sum(e["amount"] for e in batch)
+        leaderboards.apply(ex, cu)
+        async with self.io_lock:
+            # the batch is durable in the DB, so drop it from the journal even if more arrived since
+            await asyncio.to_thread(self._rewrite, self.pending[:])
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self.wake.wait(), LEDGER_FLUSH_SECS)
+            except asyncio.TimeoutError: pass
+            self.wake.clear()
+            try: await self.flush()
+            except Exception as err: print(f"⚠️ ledger flush failed: {err!r}")
+
+    async def start(self):
+        row = await db.fetchone("SELECT total FROM global_total WHERE id=1;", name="load_global_total")
+        self.db_total = row[0] if row else 0
+        # replay whatever a previous run journaled but never committed
+        self.pending = await asyncio.to_thread(self._read)
+        self.pending_total = sum(e["amount"] for e in self.pending)
+        await self.flush()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task: self.task.cancel(); self.task = None
+        await self._sync(); await self.flush()
+
+ledger = ExchangeLedger(LEDGER_JOURNAL)
+
+async def add_exchange(exchanger_id: int, customer_id: int, amount: int, fee: int = 0, method: str = ""):
+    # amounts in cents; returns once the exchange is durable in the journal; the DB catches up within LEDGER_FLUSH_SECS
+    await ledger.record(exchanger_id, customer_id, amount, fee, method)
+
+async def fetch_leaderboard(field: str, limit: int = 5):
+    if leaderboards.loaded: return leaderboards.boards[field].top(limit)
+    return await db.fetchall(
+        f"SELECT user_id,{field} FROM user_totals ORDER BY {field} DESC LIMIT ?;", (limit,),
+        name=f"fetch_leaderboard:{field}"
+    )
+
+def user_rank(field: str, user_id: int) -> int|None:
+    # all-time position; users with nothing on that side (tracked at 0) are unranked
+    board = leaderboards.boards[field]
+    return board.rank(user_id) if board.values.get(user_id, 0) > 0 else None
+
+# period → (label, days in window; None = all-time)
+PERIODS = {
+    "day":   ("Today",        1),
+    "week":  ("Last 7 Days",  7),
+    "month": ("Last 30 Days", 30),
+    "all":   ("All-Time",     None),
+}
+
+def window_start(days: int) -> int:
+    return int(time.time())//86400-days+1
+
+async def fetch_window_leaderboard(field: str, days: int|None, limit: int = 5):
+    if days is None: return await fetch_leaderboard(field, limit)
+    return await db.fetchall(
+        f"SELECT user_id,SUM({field}) AS s FROM user_daily WHERE day >= ? GROUP BY user_id "
+        "HAVING s > 0 ORDER BY s DESC LIMIT ?;", (window_start(days), limit),
+        name=f"window_leaderboard:{field}"
+    )
+
+async def fetch_method_stats(days: int|None):
+    return await db.fetchall(
+        "SELECT method,SUM(volume),SUM(fees),SUM(exchanges) FROM method_daily WHERE day >= ? "
+        "GROUP BY method ORDER BY 2 DESC;", (window_start(days) if days else 0,),
+        name="method_stats"
+    )
+
+async def get_global_total() -> int:
+    return ledger.db_total+ledger.pending_total
+
+class MessageRegistry:
+    # purpose → (channel_id, message_id, content_hash), mirrored in bot_messages
+    def __init__(self): self.known: dict[str, tuple[int, int, str]] = {}
+
+    async def load(self):
+        rows = await db.fetchall("SELECT purpose,channel_id,message_id,content_hash FROM bot_messages;", name="load_messages")
+        self.known = {p: (c, m, h) for p,c,m,h in rows}
+
+    def get(self, purpose: str): return self.known.get(purpose)
+
+    async def remember(self, purpose: str, channel_id: int, message_id: int, content_hash: str = ""):
+        self.known[purpose] = (channel_id, message_id, content_hash)
         await db.execute(
-            "INSERT INTO user_totals(user_id,as_exchanger,as_customer) VALUES(?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET as_exchanger = as_exchanger + excluded.as_exchanger;",
-            (exchanger_id, amount, 0)
+            "INSERT INTO bot_messages(purpose,channel_id,message_id,content_hash) VALUES(?,?,?,?) "
+            "ON CONFLICT(purpose) DO UPDATE SET channel_id=excluded.channel_id, message_id=excluded.message_id, "
+            "content_hash=excluded.content_hash;", (purpose, channel_id, message_id, content_hash),
+            name="remember_message"
         )
+
+messages = MessageRegistry()
+
+async def get_meta(key: str) -> str|None:
+    row = await db.fetchone("SELECT value FROM bot_meta WHERE key=?;", (key,), name="get_meta")
+    return row[0] if row else None
+
+async def set_meta(key: str, value: str):
+    await db.execute("INSERT INTO bot_meta(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value;",
+                     (key, value), name="set_meta")
+
+@dataclass
+class Ticket:
+    channel_id:  int
+    opener_id:   int
+    from_method: str
+    to_method:   str
+    amount:      int   # cents
+    fee:         int
+    net:         int
+    status:      str = "open"        # open | claimed | closed | completed | deleted
+    claimed_by:  int|None = None
+    message_id:  int|None = None
+    created_at:  int = 0
+
+TICKET_COLUMNS = "channel_id,opener_id,from_method,to_method,amount,fee,net,status,claimed_by,message_id,created_at"
+
+class TicketStore:
+    # open tickets live in memory for O(1) lookup by channel; every change is written through
+    def __init__(self): self.open: dict[int, Ticket] = {}
+
+    async def load(self):
+        rows = await db.fetchall(f"SELECT {TICKET_COLUMNS} FROM tickets WHERE status IN ('open','claimed');", name="load_tickets")
+        self.open = {r[0]: Ticket(*r) for r in rows}
+
+    def get(self, channel_id: int) -> Ticket|None: return self.open.get(channel_id)
+
+    async def save(self, t: Ticket) -> bool:
+        # finished tickets are final: a late save (intro job, modal) must not resurrect one
+        if t.status not in ("open", "claimed"): return False
+        self.open[t.channel_id] = t
         await db.execute(
-            "INSERT INTO user_totals(user_id,as_exchanger,as_customer) VALUES(?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET as_customer = as_customer + excluded.as_customer;",
-            (customer_id, 0, amount)
+            f"INSERT INTO tickets({TICKET_COLUMNS}) VALUES(?,?,?,?,?,?,?,?,?,?,?) "
+            "ON CONFLICT(channel_id) DO UPDATE SET amount=excluded.amount, fee=excluded.fee, net=excluded.net, "
+            "status=excluded.status, claimed_by=excluded.claimed_by, message_id=excluded.message_id;",
+            astuple(t), name="save_ticket"
         )
-        await db.commit()
+        return True
 
-async def fetch_leaderboard(field: str, limit: int = 5):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            f"SELECT user_id,{field} FROM user_totals ORDER BY {field} DESC LIMIT ?;", (limit,)
-        )
-        return await cursor.fetchall()
+    async def finish(self, t: Ticket, status: str):
+        self.open.pop(t.channel_id, None); t.status = status
+        await db.execute("UPDATE tickets SET status=?, closed_at=? WHERE channel_id=?;",
+                         (status, int(time.time()), t.channel_id), name="finish_ticket")
 
-async def get_global_total():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT total FROM global_total WHERE id=1;")
-        row = await cursor.fetchone()
-        return row[0] if row else 0.0
+tickets = TicketStore()
+
+# ─────────── LEADERBOARD INDEX ───────────
+class _Node:
+    __slots__ = ("key", "next", "width")
+    def __init__(self, key, level: int):
+        self.key, self.next, self.width = key, [None]*level, [1]*level
+
+class RankIndex:
+    # indexable skiplist ordered by (-value, user_id): O(log n) update, rank and top-N
+    LEVELS = 20
+    NIL = _Node((math.inf, math.inf), 0)
+
+    def __init__(self):
+        self.head = _Node(None, self.LEVELS)
+        self.head.next = [self.NIL]*self.LEVELS
+        self.values: dict[int, int] = {}
+
+    def __len__(self): return len(self.values)
+
+    def _insert(self, key):
+        chain, steps = [None]*self.LEVELS, [0]*self.LEVELS
+        node = self.head
+        for lvl in reversed(range(self.LEVELS)):
+            while node.next[lvl].key <= key:
+                steps[lvl] += node.width[lvl]; node = node.next[lvl]
+            chain[lvl] = node
+        d = min(self.LEVELS, 1-int(math.log(1.0-random.random(), 2.0)))
+        new, walked = _Node(key, d), 0
+        for lvl in range(d):
+            prev = chain[lvl]
+            new.next[lvl], prev.next[lvl] = prev.next[lvl], new
+            new.width[lvl] = prev.width[lvl]-walked
+            prev.width[lvl] = walked+1
+            walked += steps[lvl]
+        for lvl in range(d, self.LEVELS): chain[lvl].width[lvl] += 1
+
+    def _remove(self, key):
+        chain, node = [None]*self.LEVELS, self.head
+        for lvl in reversed(range(self.LEVELS)):
+            while node.next[lvl].key < key: node = node.next[lvl]
+            chain[lvl] = node
+        d = len(chain[0].next[0].next)
+        for lvl in range(d):
+            prev = chain[lvl]
+            prev.width[lvl] += prev.next[lvl].width[lvl]-1
+            prev.next[lvl] = prev.next[lvl].next[lvl]
+        for lvl in range(d, self.LEVELS): chain[lvl].width[lvl] -= 1
+
+    def set(self, user_id: int, value: int):
+        old = self.values.get(user_id)
+        if old is not None: self._remove((-old, user_id))
+        self.values[user_id] = value
+        self._insert((-value, user_id))
+
+    def add(self, user_id: int, delta: int):
+        self.set(user_id, self.values.get(user_id, 0)+delta)
+
+    def top(self, n: int) -> list[tuple[int, int]]:
+        out, node = [], self.head.next[0]
+        while node is not self.NIL and len(out) < n:
+            out.append((node.key[1], -node.key[0])); node = node.next[0]
+        return out
+
+    def rank(self, user_id: int) -> int|None:
+        # 1-based position, counted by summing skip widths on the way down
+        if user_id not in self.values: return None
+        key, node, pos = (-self.values[user_id], user_id), self.head, 0
+        for lvl in reversed(range(self.LEVELS)):
+            while node.next[lvl].key < key:
+                pos += node.width[lvl]; node = node.next[lvl]
+        return pos+1
+
+class Leaderboards:
+    # loaded once from user_totals, then kept current by the ledger after each commit
+    def __init__(self):
+        self.boards = {"as_exchanger": RankIndex(), "as_customer": RankIndex()}
+        self.loaded = False
+
+    async def load(self):
+        rows = await db.fetchall("SELECT user_id,as_exchanger,as_customer FROM user_totals;", name="load_leaderboards")
+        for uid,ex,cu in rows:
+            self.boards["as_exchanger"].set(uid, ex); self.boards["as_customer"].set(uid, cu)
+        self.loaded = True
+
+    def apply(self, exchanger_deltas: dict[int, int], customer_deltas: dict[int, int]):
+        ex, cu = self.boards["as_exchanger"], self.boards["as_customer"]
+        for uid,d in exchanger_deltas.items():
+            ex.add(uid, d)
+            if uid not in cu.values: cu.set(uid, 0)
+        for uid,d in customer_deltas.items():
+            cu.add(uid, d)
+            if uid not in ex.values: ex.set(uid, 0)
+
+leaderboards = Leaderboards()
 
 # ───────────── HELPERS ─────────────
-def calculate_fee(amount: float, method: str) -> tuple[float,float]:
-    m = method.lower()
-    if m == "crypto":
-        fee = MIN_FEE if amount < 60 else amount * 0.05
-    else:
-        fee = MIN_FEE if amount < 30 else amount * 0.10
-    fee = round(fee,2)
-    return fee, round(amount-fee,2)
-
-def user_limit(member: discord.Member) -> float|None:
-    # pick lowest numeric limit, or None if unlimited
-    vals = [LIMITS[r.name] for r in member.roles if r.name in LIMITS]
-    if None in vals: return None
-    return min(vals) if vals else 0.0
+def to_cents(value) -> int:
+    # exact dollars → cents, rounded half-up; floats go through their repr, never binary
+    c = (Decimal(str(value))*100).quantize(Decimal(1), ROUND_HALF_UP)
+    if not c.is_finite(): raise ValueError(f"not an amount: {value!r}")
+    return int(c)
+
+def usd(cents: int, commas: bool = True) -> str:
+    return format(Decimal(cents).scaleb(-2), ",.2f" if commas else ".2f")
+
+def bps(rate: str) -> int: return int(Decimal(rate)*10000)
+
+def compile_fee_table() -> dict[tuple[str, str], tuple[int, int]]:
+    # (from, to) → (rate in basis points, minimum in cents); to="" is the sending method's default
+    table = {}
+    for frm,_i,rate in PAYMENT_METHODS:
+        table[(frm.lower(), "")] = (bps(rate), to_cents(MIN_FEE))
+        for to,*_ in PAYMENT_METHODS:
+            r, m = PAIR_FEES.get((frm, to), (rate, MIN_FEE))
+            table[(frm.lower(), to.lower())] = (bps(r), to_cents(m))
+    return table
+
+FEE_TABLE   = compile_fee_table()
+DEFAULT_FEE = (bps(DEFAULT_RATE), to_cents(MIN_FEE))
+PROMOS      = [(start, end, to_cents(m), label) for start,end,m,label in FEE_PROMOS]
+
+def active_promo(at: datetime|None = None) -> tuple[int, str]|None:
+    # (minimum in cents, label) of the cheapest promo running at `at`
+    at = at or datetime.now(timezone.utc)
+    live = [(m, label) for start,end,m,label in PROMOS if start <= at and (end is None or at < end)]
+    return min(live) if live else None
+
+def fee_rule(from_method: str, to_method: str = "") -> tuple[int,int]:
+    # (rate in basis points, minimum in cents) for the pair, with any running promo applied
+    frm = from_method.lower()
+    rate, minimum = FEE_TABLE.get((frm, to_method.lower())) or FEE_TABLE.get((frm, ""), DEFAULT_FEE)
+    promo = active_promo()
+    return rate, min(minimum, promo[0]) if promo else minimum
+
+def percent(rate: int) -> str:
+    # basis points → "10", "7.5"
+    return format(Decimal(rate).scaleb(-2).normalize(), "f")
+
+def fee_label(from_method: str, to_method: str = "") -> str:
+    return f"{percent(fee_rule(from_method, to_method)[0])} % Fee"
+
+def calculate_fee(amount: int, from_method: str, to_method: str = "") -> tuple[int,int]:
+    # cents in, (fee, net) cents out: max(minimum, amount × rate) with half-up rounding
+    rate, minimum = fee_rule(from_method, to_method)
+    fee = max(minimum, (amount*rate+5000)//10000)
+    return fee, amount-fee
+
+class GuildCache:
+    # role name → id map and per-member limits, resolved once and invalidated by gateway events
+    def __init__(self):
+        self.roles: dict[str, int]|None = None
+        self.limit_roles: dict[int, int|None] = {}               # role id → LIMITS value in cents
+        self.members: dict[int, tuple[bool, int|None]] = {}      # member id → (has exchanger, limit)
+
+    def invalidate_roles(self): self.roles = None; self.members.clear()
+    def invalidate_member(self, member_id: int): self.members.pop(member_id, None)
+
+    def _build_roles(self, guild: discord.Guild):
+        self.roles, self.limit_roles = {}, {}
+        for r in guild.roles:
+            self.roles.setdefault(r.name, r.id)
+            if r.name in LIMITS: self.limit_roles[r.id] = LIMITS[r.name] and to_cents(LIMITS[r.name])
+
+    def role(self, guild: discord.Guild, name: str) -> discord.Role|None:
+        if self.roles is None: self._build_roles(guild)
+        rid = self.roles.get(name)
+        return guild.get_role(rid) if rid else None
+
+    def limits(self, member: discord.Member) -> tuple[bool, int|None]:
+        cached = self.members.get(member.id)
+        if cached is not None: return cached
+        if self.roles is None: self._build_roles(member.guild)
+        # pick lowest numeric limit, or None if unlimited
+        vals = [self.limit_roles[r.id] for r in member.roles if r.id in self.limit_roles]
+        limit = None if None in vals else (min(vals) if vals else 0)
+        self.members[member.id] = (bool(vals), limit)
+        return self.members[member.id]
+
+guild_cache = GuildCache()
+
+class CategoryAllocator:
+    # spreads ticket channels over "Needs Convert", "Needs Convert 2", … with live per-category counts
+    def __init__(self, base: str, cap: int = CATEGORY_CAP):
+        self.base, self.cap = base, cap
+        self.pattern = re.compile(rf"^{re.escape(base)}(?: (\d+))?$")
+        self.shards: dict[int, int]|None = None   # shard number → category id
+        self.counts: dict[int, int] = {}          # category id → channels in it
+        self.open: int|None = None                # category known to have room, tried first
+        self.reclaims: dict[int, asyncio.TimerHandle] = {}   # category id → pending reclaim
+        self.lock = asyncio.Lock()
+
+    def _name(self, n: int) -> str: return self.base if n==1 else f"{self.base} {n}"
+
+    def invalidate(self): self.shards = None
+
+    def _load(self, guild: discord.Guild):
+        self.shards, self.counts, self.open = {}, {}, None
+        for c in guild.categories:
+            m = self.pattern.match(c.name)
+            if m and int(m.group(1) or 1) not in self.shards:
+                self.shards[int(m.group(1) or 1)] = c.id; self.counts[c.id] = len(c.channels)
+
+    def _pick(self, guild: discord.Guild) -> discord.CategoryChannel|None:
+        if self.open is not None and self.counts.get(self.open, self.cap) < self.cap:
+            cat = guild.get_channel(self.open)
+            if cat: return cat
+        for n in sorted(self.shards):
+            cid = self.shards[n]
+            if self.counts[cid] < self.cap and (cat := guild.get_channel(cid)):
+                self.open = cid; return cat
+        return None
+
+    async def allocate(self, guild: discord.Guild) -> discord.CategoryChannel:
+        # reserves a slot; pair with release() if the channel never gets created
+        async with self.lock:
+            if self.shards is None: self._load(guild)
+            cat = self._pick(guild)
+            if cat is None:
+                n = next(i for i in itertools.count(1) if i not in self.shards)
+                cat = await guild.create_category(self._name(n))
+                self.shards[n], self.counts[cat.id], self.open = cat.id, 0, cat.id
+            self.counts[cat.id] += 1
+            return cat
+
+    def mark_full(self, cat: discord.CategoryChannel):
+        if cat.id in self.counts: self.counts[cat.id] = self.cap
+
+    def release(self, guild: discord.Guild, category_id: int|None):
+        if self.shards is None or category_id not in self.counts: return
+        self.counts[category_id] = max(0, self.counts[category_id]-1)
+        n = next((n for n,cid in self.shards.items() if cid==category_id), 1)
+        if n>1 and self.counts[category_id]==0:
+            # empty overflow category: keep it for a grace period so churn around the cap
+            # doesn't create and delete categories back to back
+            if old := self.reclaims.pop(category_id, None): old.cancel()
+            self.reclaims[category_id] = asyncio.get_running_loop().call_later(
+                CATEGORY_GRACE, self._reclaim, guild, n, category_id)
+
+    def _reclaim(self, guild: discord.Guild, n: int, category_id: int):
+        self.reclaims.pop(category_id, None)
+        if not self.shards or self.shards.get(n)!=category_id or self.counts.get(category_id): return
+        # still empty: forget it now so nothing is allocated into it, then delete
+        del self.shards[n], self.counts[category_id]
+        if self.open==category_id: self.open = None
+        cat = guild.get_channel(category_id)
+        if cat: jobs.submit("reclaim_category", cat.delete, context=f"category {category_id}")
+
+categories = CategoryAllocator(EXCHANGE_CATEGORY)
+
+def category_full(err: discord.HTTPException) -> bool:
+    # a full category comes back as an invalid form body (50035) on parent_id,
+    # i.e. CHANNEL_PARENT_MAX_CHANNELS; other 400s are real errors
+    return err.code==50035 and "parent_id" in err.text
+
+def user_limit(member: discord.Member) -> int|None:
+    return guild_cache.limits(member)[1]
 
 def has_exchanger(m: discord.Member) -> bool:
-    return any(r.name in LIMITS for r in m.roles)
+    return guild_cache.limits(m)[0]
+
+def is_staff(m: discord.Member) -> bool:
+    return m.guild_permissions.manage_channels
+
+class LogSink:
+    # packs log embeds into as few LOG_CHANNEL messages as possible and mirrors them to audit_log
+    def __init__(self):
+        self.buffer: list[tuple] = []   # (channel|None, embed, audit row)
+        self.wake = asyncio.Event()
+        self.task: asyncio.Task|None = None
 
-async def log_event(guild: discord.Guild, *, title: str, desc: str, colour: int = BRAND_BLUE):
-    ch = guild.get_channel(LOG_CHANNEL)
-    if not ch: return
-    e = discord.Embed(title=title, description=desc, colour=colour, timestamp=datetime.now(timezone.utc))
-    await ch.send(embed=e)
+    def push(self, ch, emb: discord.Embed, row: tuple):
+        self.buffer.append((ch, emb, row))
+        if len(self.buffer)>=LOG_BATCH: self.wake.set()
+
+    async def flush(self):
+        if not self.buffer: return
+        batch = self.buffer[:]
+        # mirror locally first so the audit trail never depends on discord;
+        # the batch leaves the buffer only once that commit lands, so a failed insert is retried next flush
+        async with db.transaction("audit_log") as conn:
+            await conn.executemany(
+                "INSERT INTO audit_log(ts,title,description,colour,user_id,channel_id) VALUES(?,?,?,?,?,?);",
+                [row for _,_,row in batch])
+        del self.buffer[:len(batch)]
+        by_chan: dict = {}
+        for ch,emb,_ in batch:
+            if ch: by_chan.setdefault(ch,[]).append(emb)
+        for ch,embeds in by_chan.items():
+            for i in range(0,len(embeds),LOG_BATCH):
+                chunk=embeds[i:i+LOG_BATCH]
+                jobs.submit("log",lambda ch=ch,chunk=chunk:ch.send(embeds=chunk),context=f"{len(chunk)} log embed(s)",lane=ch.id)
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self.wake.wait(), LOG_FLUSH_SECS)
+            except asyncio.TimeoutError: pass
+            self.wake.clear()
+            try: await self.flush()
+            except Exception as err: print(f"⚠️ log flush failed: {err!r}")
+
+    def start(self): self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task: self.task.cancel(); self.task = None
+        await self.flush()
+
+log_sink = LogSink()
+
+def log_event(guild: discord.Guild, *, title: str, desc: str, colour: int = BRAND_BLUE,
+              user_id: int|None = None, channel_id: int|None = None):
+    now = datetime.now(timezone.utc)
+    e = discord.Embed(title=title, description=desc, colour=colour, timestamp=now)
+    log_sink.push(guild.get_channel(LOG_CHANNEL), e, (int(now.timestamp()), title, desc, colour, user_id, channel_id))
+
+def ticket_embed(t: Ticket) -> discord.Embed:
+    emb=discord.Embed(title="🆕 New Exchange Request",colour=BRAND_BLUE)
+    emb.add_field(name="From → To",value=f"{t.from_method} → {t.to_method}",inline=False)
+    emb.add_field(name="Amount",value=f"$ {usd(t.amount,False)}")
+    emb.add_field(name="Fee",value=f"$ {usd(t.fee,False)}")
+    emb.add_field(name="You Receive",value=f"$ {usd(t.net,False)}")
+    rate,minimum=fee_rule(t.from_method,t.to_method)
+    emb.set_footer(text=f"Min ${usd(minimum)} + {percent(rate)}% fee • ⚡ Exchangers: Claim / Close")
+    if t.claimed_by: emb.add_field(name="🔒 Claimed by",value=f"<@{t.claimed_by}>",inline=False)
+    return emb
 
 def make_history_embed(*, exchanger: str, client_sent: str, client_received: str, thumb_url: str|None=None) -> discord.Embed:
     now = datetime.now(timezone.utc)
@@ -132,37 +883,309 @@ def make_history_embed(*, exchanger: str, client_sent: str, client_received: str
     return e
 
 def setup_embed() -> discord.Embed:
+    base, promo = usd(to_cents(MIN_FEE)), active_promo()
+    minimum = f"~~${base}~~ **${usd(promo[0])}** ({promo[1]})" if promo else f"**${base}**"
     desc = (
         "You can request a convert by selecting the appropriate option below for the payment type you'll be sending with. "
         "Follow the instructions and fill out the fields as requested.\n\n"
         "• **Reminder**\n"
         "Please read our <#1386775866385760378> before creating a Convert.\n\n"
         "• **Minimum Fees**\n"
-        "Our minimum service fee is ~~$5.00~~ **$3.00** (Launch Flash Sale!) and is non-negotiable."
+        f"Our minimum service fee is {minimum} and is non-negotiable."
     )
     e = discord.Embed(title="Convert", description=desc, colour=BRAND_BLUE)
-    methods_list = "\n".join(f"{icon} {name}" for name,_f,icon in PAYMENT_METHODS)
+    methods_list = "\n".join(f"{icon} {name}" for name,icon,_r in PAYMENT_METHODS)
     e.add_field(name="Available Methods", value=methods_list, inline=False)
     e.set_footer(text="Select a method below to begin ↴")
     return e
 
+def embed_hash(emb: discord.Embed) -> str:
+    return hashlib.sha1(json.dumps(emb.to_dict(), sort_keys=True).encode()).hexdigest()
+
+async def find_own_message(ch, title: str, limit: int = 10):
+    async for m in ch.history(limit=limit):
+        if m.author==bot.user and m.embeds and m.embeds[0].title==title: return m
+    return None
+
+async def edit_or_send(ch, purpose: str, *embeds: discord.Embed, scan: int = 10, force: bool = False, **kw):
+    h=hashlib.sha1("".join(embed_hash(e) for e in embeds).encode()).hexdigest() if len(embeds)>1 else embed_hash(embeds[0])
+    known=messages.get(purpose);embeds=list(embeds)
+    if known and known[0]==ch.id:
+        if known[2]==h and not force: return   # rendered content unchanged, skip the REST call
+        try:
+            await ch.get_partial_message(known[1]).edit(embeds=embeds,**kw)
+            return await messages.remember(purpose,ch.id,known[1],h)
+        except discord.NotFound: pass
+    # unknown or deleted: fall back to scanning history, else post a fresh one
+    msg=await find_own_message(ch,embeds[0].title,scan)
+    if msg: await msg.edit(embeds=embeds,**kw)
+    else: msg=await ch.send(embeds=embeds,**kw)
+    await messages.remember(purpose,ch.id,msg.id,h)
+
+def leaderboard_lines(rows) -> str:
+    return "\n".join(f"**{i+1}.** <@{uid}> — ${usd(amt)}" for i,(uid,amt) in enumerate(rows)) or "No data."
+
+def leaderboard_embed(title: str, rows) -> discord.Embed:
+    return discord.Embed(title=title,colour=BRAND_BLUE,description=leaderboard_lines(rows))
+
+# ───────────── METRICS ─────────────
+def _labels(labels: dict) -> str:
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+    return "{"+",".join(f'{k}="{esc(v)}"' for k,v in sorted(labels.items()))+"}"
+
+class Metrics:
+    # prometheus text exposition; counters and histograms in memory, the rest sampled at scrape time
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.hists: dict[str, dict[tuple, list]] = {}   # labels → [bucket counts…, sum, count]
+        self.help: dict[str, str] = {}
+
+    def inc(self, name: str, n: float = 1, **labels):
+        series = self.counters.setdefault(name, {}); key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0)+n
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.hists.setdefault(name, {}); key = tuple(sorted(labels.items()))
+        h = series.setdefault(key, [0]*len(self.BUCKETS)+[0.0, 0])
+        for i,b in enumerate(self.BUCKETS):
+            if value <= b: h[i] += 1
+        h[-2] += value; h[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter()-t0, **labels)
+
+    def render(self, sampled: dict[str, tuple[str, list[tuple[dict, float]]]]) -> str:
+        out = []
+        for name,series in sorted(self.counters.items()):
+            out.append(f"# TYPE {name} counter")
+            out += [f"{name}{_labels(dict(k))} {v}" for k,v in sorted(series.items())]
+        for name,series in sorted(self.hists.items()):
+            out.append(f"# TYPE {name} histogram")
+            for k,h in sorted(series.items()):
+                for b,c in zip(self.BUCKETS, h):
+                    out.append(f"{name}_bucket{_labels({**dict(k), 'le': b})} {c}")
+                out.append(f"{name}_bucket{_labels({**dict(k), 'le': '+Inf'})} {h[-1]}")
+                out.append(f"{name}_sum{_labels(dict(k))} {h[-2]}")
+                out.append(f"{name}_count{_labels(dict(k))} {h[-1]}")
+        for name,(kind,samples) in sorted(sampled.items()):
+            out.append(f"# TYPE {name} {kind}")
+            out += [f"{name}{_labels(l)} {v}" for l,v in samples]
+        return "\n".join(out)+"\n"
+
+metrics = Metrics()
+
+def timed(handler: str):
+    # interaction latency histogram, per view/button
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*a, **kw):
+            with metrics.timer("interaction_handler_seconds", handler=handler): return await fn(*a, **kw)
+        return wrapper
+    return deco
+
+def instrument_http(http):
+    # counts and times every discord REST call (including time spent waiting on buckets)
+    request = http.request
+    async def counted(route, **kw):
+        metrics.inc("discord_rest_requests_total", method=route.method, route=route.path)
+        try:
+            with metrics.timer("discord_rest_seconds", method=route.method, route=route.path):
+                return await request(route, **kw)
+        except discord.HTTPException as err:
+            metrics.inc("discord_rest_errors_total", status=err.status); raise
+    http.request = counted
+
+class RateLimitCounter(logging.Filter):
+    # discord.py retries 429s itself and only tells us through its logger. Every 429 logs
+    # "We are being rate limited…"; a global one follows it with "Global rate limit has been hit…"
+    # in the same synchronous step, so each hit is counted once, on the next loop iteration
+    def __init__(self):
+        super().__init__(); self.pending: list[str] = []   # scope of each 429 seen this iteration
+
+    def _settle(self):
+        for scope in self.pending: metrics.inc("discord_rate_limit_hits_total", scope=scope)
+        self.pending = []
+
+    def filter(self, record):
+        msg = str(record.msg)
+        if msg.startswith("We are being rate limited"):
+            if not self.pending: asyncio.get_running_loop().call_soon(self._settle)
+            self.pending.append("route")
+        elif msg.startswith("Global rate limit has been hit") and self.pending:
+            self.pending[-1] = "global"
+        return True
+
+logging.getLogger("discord.http").addFilter(RateLimitCounter())
+
+loop_lag = 0.0
+async def watch_loop_lag(interval: float = 1.0):
+    global loop_lag
+    while True:
+        t0 = time.perf_counter(); await asyncio.sleep(interval)
+        loop_lag = max(0.0, time.perf_counter()-t0-interval)
+        metrics.observe("event_loop_lag_seconds", loop_lag)
+
+def collect_metrics() -> dict[str, tuple[str, list[tuple[dict, float]]]]:
+    return {
+        "gateway_latency_seconds":     ("gauge", [({}, bot.latency if math.isfinite(bot.latency) else -1)]),
+        "event_loop_lag_last_seconds": ("gauge", [({}, loop_lag)]),
+        "open_tickets":                ("gauge", [({}, len(tickets.open))]),
+        "job_queue_depth":             ("gauge", [({}, jobs.depth)]),
+        "ledger_pending_exchanges":    ("gauge", [({}, len(ledger.pending))]),
+        "db_query_calls_total":        ("counter", [({"query": q}, c) for q,(c,_,_) in db.stats.items()]),
+        "db_query_seconds_total":      ("counter", [({"query": q}, t) for q,(_,t,_) in db.stats.items()]),
+        "db_query_seconds_max":        ("gauge", [({"query": q}, w) for q,(_,_,w) in db.stats.items()]),
+        "job_runs_total":              ("counter", [({"job": n, "outcome": "done"}, d) for n,(d,_,_,_) in jobs.stats.items()]
+                                                 +[({"job": n, "outcome": "dead"}, f) for n,(_,f,_,_) in jobs.stats.items()]),
+        "job_seconds_total":           ("counter", [({"job": n}, t) for n,(_,_,t,_) in jobs.stats.items()]),
+    }
+
 # ───────────── HEALTHCHECK ─────────────
-async def health(request): return web.Response(text="OK")
+async def health(request):
+    # ready = gateway connected and the DB answers
+    ok = bot.is_ready() and not bot.is_closed() and math.isfinite(bot.latency)
+    if ok:
+        try: await asyncio.wait_for(db.fetchone("SELECT 1;", name="health"), 1.0)
+        except Exception: ok = False
+    return web.Response(text="OK" if ok else "NOT READY", status=200 if ok else 503)
+async def job_stats(request): return web.json_response(jobs.snapshot())
+async def metrics_page(request):
+    return web.Response(text=metrics.render(collect_metrics()), content_type="text/plain", charset="utf-8")
 async def start_health_server():
     app = web.Application()
     app.router.add_get("/health", health)
+    app.router.add_get("/jobs", job_stats)
+    app.router.add_get("/metrics", metrics_page)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner,"0.0.0.0",8080)
     await site.start()
 
+# ───────────── JOB PIPELINE ─────────────
+class JobQueue:
+    # interaction side effects run here, off the response path, with retries + dead letters
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.n_workers, self.workers = workers, []
+        self.running = self.delayed = 0
+        self.lanes: dict[object, deque] = {}   # lane → jobs waiting behind the one in flight
+        self.stats: dict[str, list] = {}       # job name → [done, dead, total secs, max secs]
+
+    @property
+    def depth(self) -> int: return self.queue.qsize()+self.running+self.delayed+sum(map(len, self.lanes.values()))
+
+    def submit(self, name: str, factory, *, context: str = "", lane=None):
+        # factory returns a fresh awaitable per attempt so the job can be retried;
+        # jobs sharing a lane (a channel id) run one at a time in submit order, retries included
+        job = (name, factory, context, time.monotonic(), 1, lane)
+        if lane is not None:
+            if lane in self.lanes: self.lanes[lane].append(job); return
+            self.lanes[lane] = deque()
+        self.queue.put_nowait(job)
+
+    def _requeue(self, job):
+        self.delayed -= 1; self.queue.put_nowait(job)
+
+    def _release(self, lane):
+        if lane is None: return
+        waiting = self.lanes.get(lane)
+        if waiting: self.queue.put_nowait(waiting.popleft())
+        else: self.lanes.pop(lane, None)
+
+    async def _worker(self):
+        while True:
+            name,factory,context,t0,attempt,lane=await self.queue.get()
+            self.running+=1;retry=False
+            try:
+                await factory()
+            except (discord.NotFound, discord.Forbidden) as err:
+                await self._finish(name,t0,False,context,err,attempt)   # retrying won't help
+            except Exception as err:
+                if attempt<JOB_ATTEMPTS:
+                    self.delayed+=1;retry=True   # keeps its lane, so later jobs wait for it
+                    asyncio.get_running_loop().call_later(min(60,2**attempt)+random.random(),
+                        self._requeue,(name,factory,context,t0,attempt+1,lane))
+                else: await self._finish(name,t0,False,context,err,attempt)
+            else:
+                await self._finish(name,t0,True)
+            finally:
+                self.running-=1;self.queue.task_done()
+                if not retry: self._release(lane)
+
+    async def _finish(self, name, t0, ok, context="", err=None, attempts=0):
+        dt=time.monotonic()-t0;s=self.stats.setdefault(name,[0,0,0.0,0.0])
+        s[0 if ok else 1]+=1;s[2]+=dt;s[3]=max(s[3],dt)
+        if ok: return
+        print(f"⚠️ job {name} dead after {attempts} attempt(s): {err!r}")
+        try:
+            await db.execute("INSERT INTO dead_jobs(name,context,error,attempts,failed_at) VALUES(?,?,?,?,?);",
+                             (name,context,repr(err),attempts,int(time.time())),name="dead_job")
+        except Exception as db_err: print(f"⚠️ could not record dead job: {db_err!r}")
+
+    def snapshot(self) -> dict:
+        return {"depth":self.depth,"running":self.running,"delayed":self.delayed,"lanes":len(self.lanes),
+                "jobs":{n:{"done":d,"dead":f,"avg_secs":t/max(d+f,1),"max_secs":m} for n,(d,f,t,m) in self.stats.items()}}
+
+    def start(self):
+        self.workers=[asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+
+    async def stop(self, timeout: float = 10):
+        # give in-flight side effects a chance to land before shutdown
+        deadline=time.monotonic()+timeout
+        while self.depth and time.monotonic()<deadline: await asyncio.sleep(0.1)
+        for w in self.workers: w.cancel()
+        self.workers=[]
+
+jobs = JobQueue()
+
+# ───────────── TOTAL CONVERTED VC ─────────────
+class TotalChannelUpdater:
+    # coalesces total changes into as few renames as the rate-limit budget allows
+    def __init__(self):
+        self.dirty = asyncio.Event()
+        self.renames: deque[float] = deque(maxlen=VC_RENAMES_PER_WINDOW)
+        self.task: asyncio.Task|None = None
+
+    def poke(self): self.dirty.set()
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            await self.dirty.wait()
+            if len(self.renames)==self.renames.maxlen:
+                wait=self.renames[0]+VC_RENAME_WINDOW-time.monotonic()
+                if wait>0: await asyncio.sleep(wait)
+            # anything poked while we slept is folded into this one rename
+            self.dirty.clear()
+            vc=bot.get_channel(VC_TOTAL_ID)
+            if not isinstance(vc,discord.VoiceChannel): continue
+            name=f"Total Converted: ${usd(await get_global_total())}"
+            if name==vc.name: continue
+            try: await vc.edit(name=name)
+            except discord.HTTPException as err: print(f"⚠️ total VC rename failed: {err}")
+            self.renames.append(time.monotonic())
+
+    def start(self):
+        self.task=asyncio.create_task(self._run());self.poke()
+
+    def stop(self):
+        if self.task: self.task.cancel();self.task=None
+
+total_updater = TotalChannelUpdater()
+
 # ───────────── VIEWS & MODALS ─────────────
 class PaymentFrom(ui.Select):
     def __init__(self):
         super().__init__(placeholder="From…", custom_id="from_method",
                          min_values=1,max_values=1,
-                         options=[discord.SelectOption(label=n,description=f,emoji=i)
-                                  for n,f,i in PAYMENT_METHODS])
+                         options=[discord.SelectOption(label=n,description=fee_label(n),emoji=i)
+                                  for n,i,_r in PAYMENT_METHODS])
     async def callback(self, inter):
         v=SetupView();v.from_method=self.values[0];v.clear_items();v.add_item(PaymentTo(v))
         await inter.response.send_message(embed=discord.Embed(title="🔁 From selected",
@@ -170,8 +1193,8 @@ class PaymentFrom(ui.Select):
 class PaymentTo(ui.Select):
     def __init__(self,parent:SetupView):
         super().__init__(placeholder="To…",min_values=1,max_values=1,
-                         options=[discord.SelectOption(label=n,description=f,emoji=i)
-                                  for n,f,i in PAYMENT_METHODS if n!=parent.from_method])
+                         options=[discord.SelectOption(label=n,description=fee_label(parent.from_method,n),emoji=i)
+                                  for n,i,_r in PAYMENT_METHODS if n!=parent.from_method])
         self.parent=parent
     async def callback(self,inter):
         self.parent.to_method=self.values[0]
@@ -185,199 +1208,365 @@ class SetupView(ui.View):
 class AmountModal(ui.Modal,title="💰 Enter Amount ⚡"):
     amount=ui.TextInput(label="USD Amount",placeholder="e.g. 200.00",required=True)
     def __init__(self,parent:SetupView):super().__init__();self.parent=parent
+    @timed("modal_submit")
     async def on_submit(self,inter):
-        try:amt=float(self.amount.value.replace(',','').replace('$',''))
+        try:amt=to_cents(self.amount.value.replace(',','').replace('$','').strip())
         except: return await inter.response.send_message("❌ Enter a valid number.",ephemeral=True)
-        fee,net=calculate_fee(amt,self.parent.from_method)
-        g=inter.guild;cat=discord.utils.get(g.categories,name=EXCHANGE_CATEGORY) or await g.create_category(EXCHANGE_CATEGORY)
+        fee,net=calculate_fee(amt,self.parent.from_method,self.parent.to_method)
+        await inter.response.defer(ephemeral=True,thinking=True)
+        g=inter.guild
         perms={g.default_role:discord.PermissionOverwrite(view_channel=False),
                inter.user:discord.PermissionOverwrite(view_channel=True,send_messages=True),
                g.me:discord.PermissionOverwrite(view_channel=True,send_messages=True)}
-        exch=discord.utils.get(g.roles,name="Exchanger")
+        exch=guild_cache.role(g,"Exchanger")
         if exch: perms[exch]=discord.PermissionOverwrite(view_channel=True,send_messages=True)
-        suffix=str(int(amt)) if amt.is_integer() else f"{amt:.2f}".replace('.', '-')
+        suffix=str(amt//100) if amt%100==0 else usd(amt,False).replace('.', '-')
         name=f"{self.parent.from_method.lower()}-{self.parent.to_method.lower()}-{suffix}"
-        chan=await g.create_text_channel(name,category=cat,overwrites=perms)
-        emb=discord.Embed(title="🆕 New Exchange Request",colour=BRAND_BLUE)
-        emb.add_field(name="From → To",value=f"{self.parent.from_method} → {self.parent.to_method}",inline=False)
-        emb.add_field(name="Amount",value=f"$ {amt:.2f}")
-        emb.add_field(name="Fee",value=f"$ {fee:.2f}")
-        emb.add_field(name="You Receive",value=f"$ {net:.2f}")
-        emb.set_footer(text="Min $3 + 10% (5% crypto) fee • ⚡ Exchangers: Claim / Close")
-        await chan.send("@everyone **New ticket!**",allowed_mentions=discord.AllowedMentions(everyone=True),embed=emb,view=TicketView(amt,fee,net))
-        await inter.response.send_message(f"✅ Ticket created: {chan.mention}",ephemeral=True)
-        await log_event(g,title="Ticket created",desc=f"{inter.user.mention} opened {chan.mention} for {self.parent.from_method} → {self.parent.to_method} at ${amt:.2f}")
-
-class TicketView(ui.View):
-    def __init__(self, amt:float, fee:float, net:float):
+        chan=None
+        try:
+            for attempt in range(CATEGORY_TRIES):
+                cat=await categories.allocate(g)
+                try: chan=await g.create_text_channel(name,category=cat,overwrites=perms);break
+                except discord.HTTPException as err:
+                    categories.release(g,cat.id)
+                    if not category_full(err) or attempt==CATEGORY_TRIES-1: raise
+                    # category filled up behind our back (e.g. channels added by hand): spill over
+                    categories.mark_full(cat)
+            t=Ticket(chan.id,inter.user.id,self.parent.from_method,self.parent.to_method,amt,fee,net,created_at=int(time.time()))
+            await tickets.save(t)
+            # inline, so the buttons are there by the time the opener follows the link
+            try: await post_ticket_intro(chan,t)
+            except discord.HTTPException: jobs.submit("ticket_intro",lambda:post_ticket_intro(chan,t),context=f"channel {chan.id}",lane=chan.id)
+        except Exception:
+            # we deferred with "thinking…", so the opener has to hear about it; don't orphan a half-made channel
+            if chan: jobs.submit("delete_channel",chan.delete,context=f"channel {chan.id}",lane=chan.id)
+            with contextlib.suppress(discord.HTTPException):
+                await inter.followup.send("❌ Could not create your ticket, please try again.",ephemeral=True)
+            raise
+        await inter.followup.send(f"✅ Ticket created: {chan.mention}",ephemeral=True)
+        desc=f"{inter.user.mention} opened {chan.mention} for {self.parent.from_method} → {self.parent.to_method} at ${usd(amt)}"
+        log_event(g,title="Ticket created",desc=desc,user_id=inter.user.id,channel_id=chan.id)
+
+async def post_ticket_intro(chan,t:Ticket):
+    msg=await chan.send("@everyone **New ticket!**",allowed_mentions=discord.AllowedMentions(everyone=True),embed=ticket_embed(t),view=TicketView(t))
+    t=tickets.get(chan.id)   # may have been closed while the send was in flight
+    if t: t.message_id=msg.id;await tickets.save(t)
+
+class TicketRouter:
+    # one dispatcher for every ticket button: custom_ids are ticket:<action>:<channel_id>[:<arg>]
+    # and state comes from the ticket store, so buttons keep working across restarts
+    def __init__(self): self.handlers={}
+    def action(self,name):
+        def deco(fn): self.handlers[name]=fn;return fn
+        return deco
+    async def dispatch(self,inter:discord.Interaction):
+        if inter.type!=discord.InteractionType.component: return
+        cid=(inter.data or {}).get("custom_id","")
+        if not cid.startswith("ticket:"): return
+        _,action,*args=cid.split(":")
+        handler=self.handlers.get(action);t=tickets.get(int(args[0])) if args else None
+        if handler is None or t is None:
+            return await inter.response.send_message("⚠️ This ticket is no longer active.",ephemeral=True)
+        with metrics.timer("interaction_handler_seconds",handler=action): await handler(inter,t,*args[1:])
+
+ticket_router=TicketRouter()
+
+class TicketControls(ui.View):
+    # render-only: clicks are served by ticket_router, so the view is stopped before it is
+    # sent and discord.py never keeps a live View per ticket message
+    BUTTONS=()
+    def __init__(self,t:Ticket,*args):
         super().__init__(timeout=None)
-        self.amt,self.fee,self.net=amt,fee,net
-    @ui.button(label="🏷️ Claim",style=discord.ButtonStyle.primary)
-    async def claim(self, inter, _):
-        if not has_exchanger(inter.user):
-            return await inter.response.send_message("🚫 Exchanger role required.",ephemeral=True)
-        limit=user_limit(inter.user)
-        if limit is not None and self.amt>limit:
-            over=self.amt-limit
-            dr=discord.Embed(title="⚠️ Claim Request - Limit Exceeded",colour=discord.Color.gold(),
-                description=(f"**{inter.user.mention}** wants to claim your **${self.amt:.2f}** ticket but exceeds their limit ${limit:.2f} (over by ${over:.2f}).\n\n"
-                              "🚨 **RISK**: No refund if exchanger exits.\n\n"
-                              "**Accept** or **Deny**."))
-            view=ClaimRequestView(opener=inter.message.author,exchanger=inter.user,channel=inter.channel,amt=self.amt)
-            msg=await inter.response.send_message(content=f"{inter.message.author.mention}, {inter.user.mention} requests claim:",embed=dr,view=view,ephemeral=False)
-            view.msg=msg;return
-        # within limit
-        exch=discord.utils.get(inter.guild.roles,name="Exchanger")
-        if exch: await inter.channel.set_permissions(exch,view_channel=False)
-        await inter.channel.set_permissions(inter.user,view_channel=True,send_messages=True)
-        emb=inter.message.embeds[0].copy()
-        emb.add_field(name="🔒 Claimed by",value=inter.user.mention,inline=False)
-        await inter.response.edit_message(embed=emb,view=ClaimedView(self.amt,self.fee,self.net,inter.message.embeds[0]))
-        await log_event(inter.guild,title="Ticket claimed",desc=f"{inter.user.mention} claimed {inter.channel.mention}")
-    @ui.button(label="✏️ Change Amount",style=discord.ButtonStyle.secondary)
-    async def change_amount(self,inter,_):
-        await inter.response.send_modal(ChangeAmountModal(self))
-    @ui.button(label="⚙️ Change Fee",style=discord.ButtonStyle.secondary)
-    async def change_fee(self,inter,_):
-        await inter.response.send_modal(ChangeFeeModal(self))
-    @ui.button(label="🗑️ Close",style=discord.ButtonStyle.danger)
-    async def close(self,inter,_):
-        if not has_exchanger(inter.user):return await inter.response.send_message("🚫 Exchangers only.",ephemeral=True)
-        await inter.response.send_message("Sure? This will close.",view=ConfirmClose(inter.channel,inter.user),ephemeral=True)
+        suffix="".join(f":{a}" for a in (t.channel_id,*args))
+        for label,style,action in self.BUTTONS:
+            self.add_item(ui.Button(label=label,style=style,custom_id=f"ticket:{action}{suffix}"))
+        self.stop()
+
+class TicketView(TicketControls):
+    BUTTONS=(("🏷️ Claim",discord.ButtonStyle.primary,"claim"),
+             ("✏️ Change Amount",discord.ButtonStyle.secondary,"amount"),
+             ("⚙️ Change Fee",discord.ButtonStyle.secondary,"fee"),
+             ("🗑️ Close",discord.ButtonStyle.danger,"close"))
+
+class ClaimedView(TicketControls):
+    BUTTONS=(("🔄 Unclaim",discord.ButtonStyle.secondary,"unclaim"),
+             ("✅ Complete",discord.ButtonStyle.success,"complete"))
+
+class ClaimRequestView(TicketControls):
+    # built with the requesting exchanger's id as the extra custom_id arg
+    BUTTONS=(("✅ Accept",discord.ButtonStyle.success,"accept"),
+             ("❌ Deny",discord.ButtonStyle.danger,"deny"))
+
+def set_claim_perms(ch,guild,member,claimed:bool):
+    # one lane per channel: a claim's overwrites always land before a later unclaim's
+    ctx,lane=f"channel {ch.id}",ch.id
+    exch=guild_cache.role(guild,"Exchanger")
+    if exch: jobs.submit("perms",lambda:ch.set_permissions(exch,view_channel=not claimed),context=ctx,lane=lane)
+    if member is None: return
+    if claimed: jobs.submit("perms",lambda:ch.set_permissions(member,view_channel=True,send_messages=True),context=ctx,lane=lane)
+    else: jobs.submit("perms",lambda:ch.set_permissions(member,overwrite=None),context=ctx,lane=lane)
+
+@ticket_router.action("claim")
+async def ticket_claim(inter,t:Ticket):
+    if not has_exchanger(inter.user):
+        return await inter.response.send_message("🚫 Exchanger role required.",ephemeral=True)
+    if t.claimed_by: return await inter.response.send_message(f"🔒 Already claimed by <@{t.claimed_by}>.",ephemeral=True)
+    limit=user_limit(inter.user)
+    if limit is not None and t.amount>limit:
+        over=t.amount-limit
+        dr=discord.Embed(title="⚠️ Claim Request - Limit Exceeded",colour=discord.Color.gold(),
+            description=(f"**{inter.user.mention}** wants to claim your **${usd(t.amount)}** ticket but exceeds their limit ${usd(limit)} (over by ${usd(over)}).\n\n"
+                          "🚨 **RISK**: No refund if exchanger exits.\n\n"
+                          "**Accept** or **Deny**."))
+        return await inter.response.send_message(content=f"<@{t.opener_id}>, {inter.user.mention} requests claim:",embed=dr,view=ClaimRequestView(t,inter.user.id),ephemeral=False)
+    # within limit
+    t.status,t.claimed_by="claimed",inter.user.id;await tickets.save(t)
+    await inter.response.edit_message(embed=ticket_embed(t),view=ClaimedView(t))
+    set_claim_perms(inter.channel,inter.guild,inter.user,True)
+    log_event(inter.guild,title="Ticket claimed",desc=f"{inter.user.mention} claimed {inter.channel.mention}",user_id=inter.user.id,channel_id=t.channel_id)
+
+@ticket_router.action("amount")
+async def ticket_change_amount(inter,t:Ticket):
+    await inter.response.send_modal(ChangeAmountModal(t))
+
+@ticket_router.action("fee")
+async def ticket_change_fee(inter,t:Ticket):
+    await inter.response.send_modal(ChangeFeeModal(t))
+
+@ticket_router.action("close")
+async def ticket_close(inter,t:Ticket):
+    if not has_exchanger(inter.user):return await inter.response.send_message("🚫 Exchangers only.",ephemeral=True)
+    await inter.response.send_message("Sure? This will close.",view=ConfirmClose(t,inter.channel,inter.user),ephemeral=True)
+
+@ticket_router.action("accept")
+async def ticket_accept(inter,t:Ticket,exchanger_id:str):
+    if inter.user.id!=t.opener_id: return await inter.response.send_message("🚫 Only the ticket opener can accept.",ephemeral=True)
+    if t.claimed_by: return await inter.response.edit_message(content=f"🔒 Already claimed by <@{t.claimed_by}>.",embed=None,view=None)
+    t.status,t.claimed_by="claimed",int(exchanger_id);await tickets.save(t)
+    await inter.response.edit_message(content=f"✅ Accepted — <@{t.claimed_by}> has claimed this ticket.",embed=None,view=None)
+    ch=inter.channel
+    if t.message_id: jobs.submit("ticket_message",lambda:ch.get_partial_message(t.message_id).edit(embed=ticket_embed(t),view=ClaimedView(t)),context=f"channel {ch.id}",lane=ch.id)
+    set_claim_perms(ch,inter.guild,inter.guild.get_member(t.claimed_by),True)
+    log_event(inter.guild,title="Ticket claimed",desc=f"<@{t.claimed_by}> claimed {ch.mention} (over limit, accepted)",user_id=t.claimed_by,channel_id=t.channel_id)
+
+@ticket_router.action("deny")
+async def ticket_deny(inter,t:Ticket,exchanger_id:str):
+    if inter.user.id!=t.opener_id: return await inter.response.send_message("🚫 Only the ticket opener can deny.",ephemeral=True)
+    await inter.response.edit_message(content="❌ Denied—ticket remains open.",embed=None,view=None)
+
+@ticket_router.action("unclaim")
+async def ticket_unclaim(inter,t:Ticket):
+    prev=inter.guild.get_member(t.claimed_by) if t.claimed_by else None
+    t.status,t.claimed_by="open",None;await tickets.save(t)
+    await inter.response.edit_message(embed=ticket_embed(t),view=TicketView(t))
+    set_claim_perms(inter.channel,inter.guild,prev,False)
+
+@ticket_router.action("complete")
+async def ticket_complete(inter,t:Ticket):
+    # the claimer is who gets credited, so only they (or staff) may complete
+    if not t.claimed_by: return await inter.response.send_message("⚠️ Claim the ticket before completing it.",ephemeral=True)
+    if inter.user.id!=t.claimed_by and not is_staff(inter.user):
+        return await inter.response.send_message("🚫 Only the exchanger who claimed this ticket can complete it.",ephemeral=True)
+    view=ConfirmCompleteTicket(t,inter.channel,inter.user)
+    await inter.response.send_message("Really mark complete?",view=view,ephemeral=True)
 
 class ChangeAmountModal(ui.Modal,title="Change Amount ⚡"):
     new_amount=ui.TextInput(label="New USD Amount",placeholder="e.g. 200.00",required=True)
-    def __init__(self,parent):super().__init__();self.parent=parent
+    def __init__(self,t:Ticket):super().__init__();self.t=t
+    @timed("change_amount_submit")
     async def on_submit(self,inter):
-        try:na=float(self.new_amount.value)
+        try:na=to_cents(self.new_amount.value.replace(',','').replace('$','').strip())
         except: return await inter.response.send_message("❌ Invalid amount.",ephemeral=True)
-        fee,net=calculate_fee(na,"")
-        self.parent.amt, self.parent.fee, self.parent.net=na,fee,net
-        emb=inter.message.embeds[0]
-        emb.set_field_at(1,name="Amount",value=f"$ {na:.2f}")
-        emb.set_field_at(2,name="Fee",value=f"$ {fee:.2f}")
-        emb.set_field_at(3,name="You Receive",value=f"$ {net:.2f}")
-        await inter.response.edit_message(embed=emb,view=self.parent)
+        t=tickets.get(self.t.channel_id)
+        if t is None: return await inter.response.send_message("⚠️ This ticket is no longer active.",ephemeral=True)
+        fee,net=calculate_fee(na,t.from_method,t.to_method)
+        t.amount,t.fee,t.net=na,fee,net;await tickets.save(t)
+        await inter.response.edit_message(embed=ticket_embed(t),view=ClaimedView(t) if t.claimed_by else TicketView(t))
 
 class ChangeFeeModal(ui.Modal,title="Change Fee ⚙️"):
     new_fee=ui.TextInput(label="New Fee",placeholder="e.g. 5.00",required=True)
-    def __init__(self,parent):super().__init__();self.parent=parent
+    def __init__(self,t:Ticket):super().__init__();self.t=t
+    @timed("change_fee_submit")
     async def on_submit(self,inter):
-        try:nf=float(self.new_fee.value)
+        try:nf=to_cents(self.new_fee.value.replace('$','').strip())
         except:return await inter.response.send_message("❌ Invalid fee.",ephemeral=True)
-        self.parent.fee, self.parent.net = nf, round(self.parent.amt-nf,2)
-        emb=inter.message.embeds[0]
-        emb.set_field_at(2,name="Fee",value=f"$ {nf:.2f}")
-        emb.set_field_at(3,name="You Receive",value=f"$ {self.parent.net:.2f}")
-        await inter.response.edit_message(embed=emb,view=self.parent)
-
-class ClaimRequestView(ui.View):
-    def __init__(self, opener, exchanger, channel, amt):
-        super().__init__(timeout=86400)
-        self.opener, self.exchanger, self.channel, self.amt = opener, exchanger, channel, amt
-    @ui.button(label="✅ Accept",style=discord.ButtonStyle.success)
-    async def accept(self,inter,_):
-        exch=discord.utils.get(inter.guild.roles,name="Exchanger")
-        if exch: await self.channel.set_permissions(exch,view_channel=False)
-        await self.channel.set_permissions(self.exchanger,view_channel=True,send_messages=True)
-        emb=self.channel.last_message.embeds[0].copy()
-        emb.add_field(name="🔒 Claimed by",value=self.exchanger.mention,inline=False)
-        await inter.response.edit_message(embed=emb,view=ClaimedView(self.amt, *()),)
-    @ui.button(label="❌ Deny",style=discord.ButtonStyle.danger)
-    async def deny(self,inter,_):
-        await inter.response.edit_message(content="❌ Denied—ticket remains open.",view=None)
-
-class ClaimedView(ui.View):
-    def __init__(self, amt, fee, net, orig_embed):
-        super().__init__(timeout=None)
-        self.amt,self.fee,self.net,self.orig=amt,fee,net,orig_embed
-    @ui.button(label="🔄 Unclaim",style=discord.ButtonStyle.secondary)
-    async def unclaim(self,inter,_):
-        exch=discord.utils.get(inter.guild.roles,name="Exchanger")
-        if exch: await inter.channel.set_permissions(exch,view_channel=True)
-        await inter.channel.set_permissions(inter.user,overwrite=None)
-        await inter.response.edit_message(embed=self.orig,view=TicketView(self.orig.fields[1].value, self.orig.fields[2].value, self.orig.fields[3].value))
-    @ui.button(label="✅ Complete",style=discord.ButtonStyle.success)
-    async def complete(self,inter,_):
-        view=ConfirmCompleteTicket(inter.message.channel,inter.user,self.amt)
-        await inter.response.send_message("Really mark complete?",view=view,ephemeral=True)
+        t=tickets.get(self.t.channel_id)
+        if t is None: return await inter.response.send_message("⚠️ This ticket is no longer active.",ephemeral=True)
+        t.fee,t.net=nf,t.amount-nf;await tickets.save(t)
+        await inter.response.edit_message(embed=ticket_embed(t),view=ClaimedView(t) if t.claimed_by else TicketView(t))
 
 class ConfirmClose(ui.View):
-    def __init__(self, channel, user):
-        super().__init__(timeout=30);self.chan,self.user=channel,user
+    def __init__(self, t, channel, user):
+        super().__init__(timeout=30);self.t,self.chan,self.user=t,channel,user
     @ui.button(label="Yes, close",style=discord.ButtonStyle.danger)
+    @timed("close_confirm")
     async def yes(self,inter,_):
         if inter.user!=self.user: return await inter.response.send_message("Not authorized.",ephemeral=True)
-        await log_event(inter.guild,title="Ticket closed",desc=f"{self.user.mention} closed {self.chan.mention}",colour=0xFF4500)
-        await inter.response.edit_message(content="Closed 🔒",view=None);await self.chan.delete()
+        if tickets.get(self.t.channel_id) is not self.t: return await inter.response.edit_message(content="Already closed.",view=None)
+        await tickets.finish(self.t,"closed")
+        await inter.response.edit_message(content="Closed 🔒",view=None)
+        ctx=f"channel {self.chan.id}"
+        log_event(inter.guild,title="Ticket closed",desc=f"{self.user.mention} closed {self.chan.mention}",colour=0xFF4500,user_id=self.user.id,channel_id=self.chan.id)
+        jobs.submit("delete_channel",self.chan.delete,context=ctx,lane=self.chan.id)
     @ui.button(label="Cancel",style=discord.ButtonStyle.secondary)
     async def no(self,inter,_): await inter.response.edit_message(content="Cancel.",view=None)
 
 class ConfirmCompleteTicket(ui.View):
-    def __init__(self, channel, exchanger, amt): super().__init__(timeout=30);self.chan, self.exchanger, self.amt = channel, exchanger, amt
+    def __init__(self, t, channel, user): super().__init__(timeout=30);self.t, self.chan, self.user = t, channel, user
     @ui.button(label="Yes, complete",style=discord.ButtonStyle.success)
+    @timed("complete_confirm")
     async def yes(self,inter,_):
-        # log history
-        fee,net=calculate_fee(self.amt,"")
-        emb=make_history_embed(exchanger=self.exchanger.mention,client_sent=f"**$ {self.amt:.2f}**",client_received=f"**$ {net:.2f}**",thumb_url=self.exchanger.display_avatar.url)
-        await inter.guild.get_channel(HISTORY_CHANNEL).send(embed=emb)
-        # update DB
-        await add_exchange(self.exchanger.id, self.chan.category.members[0].id if self.chan.category.members else 0, self.amt)
-        # update voice channel
-        total=await get_global_total();vc=inter.guild.get_channel(VC_TOTAL_ID)
-        if vc and isinstance(vc,discord.VoiceChannel): await vc.edit(name=f"Total Converted: ${total:,.2f}")
-        await log_event(inter.guild,title="Exchange completed",desc=f"{self.chan.mention} by {self.exchanger.mention}",colour=0x00C853)
+        t=self.t
+        if tickets.get(t.channel_id) is not t: return await inter.response.edit_message(content="Already closed.",view=None)
+        # re-checked here: the ticket may have been unclaimed or re-claimed since the prompt
+        if not t.claimed_by or (inter.user.id!=t.claimed_by and not is_staff(inter.user)):
+            return await inter.response.edit_message(content="🚫 This ticket is no longer claimed by you.",view=None)
+        ex_id=t.claimed_by
+        await tickets.finish(t,"completed")
+        # update DB (durable once the ledger journal is synced); credit goes to the claimer
+        try: await add_exchange(ex_id, t.opener_id, t.amount, t.fee, t.from_method)
+        except Exception:
+            t.status="claimed" if t.claimed_by else "open";await tickets.save(t);raise
         await inter.response.edit_message(content="Logged ✅ — closing…",view=None)
-        await self.chan.delete()
+        # update voice channel (debounced in the background)
+        total_updater.poke()
+        # history post and channel removal run as background jobs; the log is batched
+        ex=inter.guild.get_member(ex_id)
+        emb=make_history_embed(exchanger=f"<@{ex_id}>",client_sent=f"**$ {usd(t.amount,False)}**",client_received=f"**$ {usd(t.net,False)}**",thumb_url=ex.display_avatar.url if ex else None)
+        hist,ctx=inter.guild.get_channel(HISTORY_CHANNEL),f"channel {self.chan.id}"
+        jobs.submit("history",lambda:hist.send(embed=emb),context=ctx)
+        by=f"<@{ex_id}>"+(f" (marked by {inter.user.mention})" if inter.user.id!=ex_id else "")
+        log_event(inter.guild,title="Exchange completed",desc=f"{self.chan.mention} by {by}",colour=0x00C853,user_id=ex_id,channel_id=self.chan.id)
+        jobs.submit("delete_channel",self.chan.delete,context=ctx,lane=self.chan.id)
     @ui.button(label="Cancel",style=discord.ButtonStyle.secondary)
     async def cancel(self,inter,_): await inter.response.edit_message(content="Canceled.",view=None)
 
 # ───────────── BOT STARTUP ─────────────
+class ExchangeBot(commands.Bot):
+    async def close(self):
+        total_updater.stop()
+        await log_sink.stop()
+        await jobs.stop()
+        await super().close()
+        await ledger.stop()
+        await db.close()
+
 intents=discord.Intents.default();intents.members=True
-bot=commands.Bot(command_prefix="!",intents=intents)
+bot=ExchangeBot(command_prefix="!",intents=intents)
+
+async def sync_commands():
+    # the guild tree only changes on deploys; skip the sync (and its rate limit) when it's the same
+    guild=discord.Object(id=GUILD_ID)
+    payload=[c.to_dict() for c in bot.tree.get_commands(guild=guild)]
+    h=hashlib.sha1(json.dumps(payload,sort_keys=True).encode()).hexdigest()
+    key=f"command_tree:{GUILD_ID}"
+    if await get_meta(key)==h: return
+    await bot.tree.sync(guild=guild)
+    await set_meta(key,h)
+
+async def refresh_panel():
+    # edit the registered panel in place instead of deleting and reposting; always one real edit,
+    # so a panel a moderator deleted gets reposted through the NotFound fallback
+    chan=bot.get_partial_messageable(EXCHANGE_CHANNEL)
+    await edit_or_send(chan,"panel",setup_embed(),scan=50,force=True,view=SetupView())
 
 @bot.event
 async def setup_hook():
+    await db.start()
     await init_db()
+    await asyncio.gather(leaderboards.load(), messages.load(), tickets.load())
+    await ledger.start()
+    total_updater.start()
+    jobs.start()
+    log_sink.start()
+    instrument_http(bot.http)
+    bot.loop.create_task(watch_loop_lag())
     bot.loop.create_task(start_health_server())
     bot.add_view(SetupView())
+    bot.add_listener(ticket_router.dispatch,"on_interaction")
+    # one-shot REST work lives here rather than in on_ready, which fires again on every reconnect
+    results=await asyncio.gather(sync_commands(),refresh_panel(),return_exceptions=True)
+    for step,res in zip(("command sync","panel refresh"),results):
+        if isinstance(res,Exception): print(f"⚠️ startup {step} failed: {res!r}")
+    update_leaderboards.start()
+
+@bot.event
+async def on_guild_channel_delete(ch):
+    # ticket channel removed by hand
+    t=tickets.get(ch.id)
+    if t: await tickets.finish(t,"deleted")
+
+# guild metadata cache invalidation
+@bot.listen("on_guild_role_create")
+@bot.listen("on_guild_role_delete")
+async def _roles_changed(role): guild_cache.invalidate_roles()
+
+@bot.listen("on_guild_role_update")
+async def _role_updated(before, after): guild_cache.invalidate_roles()
+
+@bot.listen("on_guild_channel_delete")
+async def _channel_deleted(ch):
+    if isinstance(ch,discord.CategoryChannel): categories.invalidate()
+    else: categories.release(ch.guild,ch.category_id)
+
+@bot.listen("on_guild_channel_update")
+async def _channel_updated(before, after):
+    # channels moved between categories or categories renamed by hand: recount from the guild
+    if before.category_id!=after.category_id or (isinstance(after,discord.CategoryChannel) and before.name!=after.name):
+        categories.invalidate()
+
+@bot.listen("on_member_update")
+async def _member_updated(before, after):
+    if before.roles!=after.roles: guild_cache.invalidate_member(after.id)
+
+@bot.listen("on_member_remove")
+async def _member_removed(member): guild_cache.invalidate_member(member.id)
 
 @bot.event
 async def on_ready():
-    await bot.tree.sync(guild=discord.Object(id=GUILD_ID))
     print(f"🔌 Logged in as {bot.user}")
-    # refresh panel
-    chan=bot.get_channel(EXCHANGE_CHANNEL)
-    if chan:
-        async for m in chan.history(limit=50):
-            if m.author==bot.user and m.embeds and m.embeds[0].title=="Convert":
-                await m.delete()
-        await chan.send(embed=setup_embed(),view=SetupView())
-    # start leaderboard loop
-    update_leaderboards.start()
+    # drop tickets whose channels vanished while we were offline
+    g=bot.get_guild(GUILD_ID)
+    if g:
+        for t in [t for cid,t in tickets.open.items() if g.get_channel(cid) is None]: await tickets.finish(t,"deleted")
 
 @tasks.loop(minutes=5)
 async def update_leaderboards():
     g=bot.get_guild(GUILD_ID)
+    if not g: return
     exch_ch, cust_ch = g.get_channel(LB_EXCH_ID), g.get_channel(LB_CUST_ID)
-    top_ex=await fetch_leaderboard("as_exchanger",5)
-    top_cu=await fetch_leaderboard("as_customer",5)
-    emb_ex=discord.Embed(title="🏆 All-Time Top Exchangers",colour=BRAND_BLUE,
-        description="\n".join(f"**{i+1}.** <@{uid}> — ${amt:,.2f}" for i,(uid,amt) in enumerate(top_ex)) or "No data.")
-    emb_cu=discord.Embed(title="🥇 All-Time Top Customers",colour=BRAND_BLUE,
-        description="\n".join(f"**{i+1}.** <@{uid}> — ${amt:,.2f}" for i,(uid,amt) in enumerate(top_cu)) or "No data.")
-    async def edit_or_send(ch,emb):
-        msg=None
-        async for m in ch.history(limit=10):
-            if m.author==bot.user and m.embeds and m.embeds[0].title==emb.title:
-                msg=m;break
-        if msg: await msg.edit(embed=emb)
-        else: await ch.send(embed=emb)
-    if exch_ch: await edit_or_send(exch_ch,emb_ex)
-    if cust_ch: await edit_or_send(cust_ch,emb_cu)
+    # all-time first (history fallback matches on the first title), then the windows
+    order=("all","month","week","day")
+    emb_ex=[leaderboard_embed(f"🏆 {PERIODS[p][0]} Top Exchangers",await fetch_window_leaderboard("as_exchanger",PERIODS[p][1],5)) for p in order]
+    emb_cu=[leaderboard_embed(f"🥇 {PERIODS[p][0]} Top Customers",await fetch_window_leaderboard("as_customer",PERIODS[p][1],5)) for p in order]
+    if exch_ch: await edit_or_send(exch_ch,"lb:exchangers",*emb_ex)
+    if cust_ch: await edit_or_send(cust_ch,"lb:customers",*emb_cu)
+
+@update_leaderboards.before_loop
+async def _leaderboards_wait(): await bot.wait_until_ready()
 
 @bot.tree.command(name="exchange",description="Show the Convert panel",guild=discord.Object(id=GUILD_ID))
 async def exchange_cmd(inter):
     await inter.response.send_message(embed=setup_embed(),view=SetupView(),ephemeral=True)
 
-bot.run(TOKEN)
\ No newline at end of file
+@bot.tree.command(name="stats",description="Top exchangers, customers and volume per method",guild=discord.Object(id=GUILD_ID))
+@app_commands.describe(period="Time window")
+@app_commands.choices(period=[app_commands.Choice(name=label,value=key) for key,(label,_d) in PERIODS.items()])
+async def stats_cmd(inter,period:str="week"):
+    label,days=PERIODS[period]
+    top_ex=await fetch_window_leaderboard("as_exchanger",days,5)
+    top_cu=await fetch_window_leaderboard("as_customer",days,5)
+    methods=await fetch_method_stats(days)
+    emb=discord.Embed(title=f"📊 Stats — {label}",colour=BRAND_BLUE)
+    emb.add_field(name="Top Exchangers",value=leaderboard_lines(top_ex),inline=False)
+    emb.add_field(name="Top Customers",value=leaderboard_lines(top_cu),inline=False)
+    emb.add_field(name="Volume by Method",inline=False,
+        value="\n".join(f"**{m or 'Unknown'}** — ${usd(vol)} · {n} exchange(s) · ${usd(fees)} fees" for m,vol,fees,n in methods) or "No data.")
+    if leaderboards.loaded:
+        ranks=[(side,user_rank(field,inter.user.id)) for side,field in (("Exchanger","as_exchanger"),("Customer","as_customer"))]
+        emb.add_field(name="Your All-Time Rank",inline=False,
+            value=" · ".join(f"{side}: {f'#{r}' if r else 'unranked'}" for side,r in ranks))
+    await inter.response.send_message(embed=emb,ephemeral=True)
+
+if __name__ == "__main__":
+    bot.run(TOKEN)